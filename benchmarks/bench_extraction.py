@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+'''
+Benchmark of the extraction backends on generated .pdf invoices, extracting
+them one after another in a single process as well as in a pool of long-lived
+workers like `add_invoices` does.
+'''
+
+from optparse import OptionParser
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import invoice_database
+from evn_generator import generate_lines, write_pdf
+
+
+def write_invoices(temp_dir, num_invoices, num_lines):
+    invoice_files = []
+    for index in xrange(num_invoices):
+        invoice_files.append(os.path.join(temp_dir, 'evn_{0:04d}.pdf'.format(index)))
+        with open(invoice_files[-1], 'wb') as invoice:
+            write_pdf(generate_lines(num_lines, seed=index), invoice)
+    return invoice_files
+
+
+def count_connections(job):
+    '''
+    extract the given invoice with the named backend, count its connection lines
+    '''
+    extractor, invoice_file = job
+    pattern = invoice_database.InvoiceParser.CONNECTION_PATTERN
+    return sum(1 for line in invoice_database.get_extractor(extractor).extract_lines(invoice_file)
+               if pattern.search(line))
+
+
+def time_sequential(extractor, invoice_files):
+    start = time.time()
+    num_connections = sum(count_connections((extractor, invoice_file))
+                          for invoice_file in invoice_files)
+    return time.time() - start, num_connections
+
+
+def time_pool(extractor, invoice_files):
+    '''
+    time the extraction by a pool of workers, including starting the pool
+    '''
+    start = time.time()
+    worker_pool = multiprocessing.Pool(multiprocessing.cpu_count(),
+                                       invoice_database.get_extractor, (extractor,))
+    try:
+        num_connections = sum(worker_pool.imap_unordered(count_connections,
+                                                         [(extractor, invoice_file)
+                                                          for invoice_file in invoice_files]))
+    finally:
+        worker_pool.close()
+        worker_pool.join()
+    return time.time() - start, num_connections
+
+
+def main():
+    cli_parser = OptionParser(usage='%prog [options]')
+    cli_parser.add_option('-k', '--invoices', dest='invoices', type='int', default=20,
+                          help='number of invoices [default: %default]')
+    cli_parser.add_option('-n', '--lines', dest='lines', type='int', default=500,
+                          help='number of connection lines per invoice [default: %default]')
+    cli_parser.add_option('-e', '--extractor', dest='extractors', action='append',
+                          choices=sorted(invoice_database.EXTRACTORS), type='choice',
+                          help='backend to benchmark (repeatable) [default: all available]')
+    options, args = cli_parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        invoice_files = write_invoices(temp_dir, options.invoices, options.lines)
+
+        print '{0:<10} | {1:<10} | {2:>9} | {3:>11} | {4:>11}'.format('backend', 'mode', 'total',
+                                                                      'per invoice', 'connections')
+        print '-' * 62
+        for extractor in options.extractors or sorted(invoice_database.EXTRACTORS):
+            try:
+                count_connections((extractor, invoice_files[0]))
+            except (ImportError, IOError, OSError) as error:
+                print '{0:<10} | unavailable: {1}'.format(extractor, error)
+                continue
+
+            for mode, benchmark in [('sequential', time_sequential), ('pool', time_pool)]:
+                total, num_connections = benchmark(extractor, invoice_files)
+                print '{0:<10} | {1:<10} | {2:>8.2f}s | {3:>9.1f}ms | {4:>11}'.format(extractor, mode, total,
+                                                                                     total / len(invoice_files) * 1000,
+                                                                                     num_connections)
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+'''
+Microbenchmark of the single-pass, line by line invoice parser against the
+former approach of one uncompiled `re.findall` sweep per connection type over
+the fully buffered text.
+'''
+
+from optparse import OptionParser
+import os
+import re
+from cStringIO import StringIO
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from invoice_database import InvoiceParser, ConnectionType, Calls, \
+                             TextMessages, MobileWebConnections
+from evn_generator import generate_invoice
+
+
+# the patterns as they were built for every connection type instance
+LEGACY_CALL_PATTERN = '%(date)s +%(time)s +%(type)s +%(destNumber)s +%(destProvider)s +%(duration)s +(%(price)s)'
+LEGACY_SMS_PATTERN = '%(date)s +%(time)s +%(type)s +%(destNumber)s +%(destProvider)s +%(quantity)s +(%(price)s)'
+LEGACY_INET_PATTERN = '%(date)s +%(time)s +%(type)s +%(gateway)s +- +%(duration)s/ +(%(quantity)s) +(%(price)s)'
+
+
+def legacy_patterns():
+    fields = {'date': '\d{2}\.\d{2}\.\d{2}',
+              'time': '\d{2}:\d{2}:\d{2}',
+              'destNumber': '\d+',
+              'destProvider': '\S+',
+              'duration': '\d+:\d{2}',
+              'quantity': '\d+',
+              'gateway': 'internet.online',
+              'price': '\d+,\d{4}'}
+    patterns = []
+    for type_ in (ConnectionType.FESTNETZ, ConnectionType.NETZEXTERN, ConnectionType.NETZINTERN):
+        patterns.append((type_, LEGACY_CALL_PATTERN % dict(fields, type=type_)))
+    patterns.append((ConnectionType.SMS, LEGACY_SMS_PATTERN % dict(fields, type=ConnectionType.SMS)))
+    patterns.append((ConnectionType.INET, LEGACY_INET_PATTERN % dict(fields, type=ConnectionType.INET)))
+    return patterns
+
+
+def legacy_parse(text, patterns):
+    '''
+    sweep and accumulate each connection type the way it used to be done,
+    return the amount per type
+    '''
+    amounts = []
+    for type_, pattern in patterns:
+        amount = 0
+        for connection in re.findall(pattern, text, re.M):
+            if isinstance(connection, tuple):
+                quantity, price = connection
+                amount += int(quantity) + (MobileWebConnections.INET_CHUNK_SIZE - (int(quantity) % MobileWebConnections.INET_CHUNK_SIZE))
+            else:
+                amount += int(round(float(connection.replace(',', '.')) / ConnectionType.FEES[type_]['net']))
+        amounts.append(amount)
+    return amounts
+
+
+def create_connection_types():
+    return [Calls(ConnectionType.FESTNETZ),
+            Calls(ConnectionType.NETZEXTERN),
+            Calls(ConnectionType.NETZINTERN),
+            TextMessages(),
+            MobileWebConnections()]
+
+
+def parse(text):
+    '''
+    stream the text through the parser, return the amount per type
+    '''
+    connection_types = create_connection_types()
+    InvoiceParser(connection_types).parse(StringIO(text))
+    for connection_type in connection_types:
+        connection_type.update_totals()
+    return [connection_type.amount for connection_type in connection_types]
+
+
+def main():
+    cli_parser = OptionParser(usage='%prog [options]')
+    cli_parser.add_option('-n', '--lines', dest='lines', type='int', action='append',
+                          help='number of connection lines (repeatable)')
+    cli_parser.add_option('-r', '--repeat', dest='repeat', type='int', default=5,
+                          help='number of timing runs, the best one is reported')
+    options, args = cli_parser.parse_args()
+
+    print '{0:>9} | {1:>10} | {2:>10} | {3:>7}'.format('lines', 'legacy', 'scanner', 'speedup')
+    print '-' * 46
+    for num_lines in options.lines or [10000, 100000]:
+        text = generate_invoice(num_lines)
+
+        # both approaches have to agree before their timings are comparable
+        assert legacy_parse(text, legacy_patterns()) == parse(text)
+
+        legacy = min(timeit.repeat(lambda: legacy_parse(text, legacy_patterns()),
+                                   number=1, repeat=options.repeat))
+        scanner = min(timeit.repeat(lambda: parse(text),
+                                    number=1, repeat=options.repeat))
+
+        print '{0:>9} | {1:>9.3f}s | {2:>9.3f}s | {3:>6.1f}x'.format(num_lines, legacy,
+                                                                 scanner, legacy / scanner)
+
+
+if __name__ == '__main__':
+    main()
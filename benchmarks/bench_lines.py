@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+'''
+Benchmark of the statistics and month queries on an account of many phone
+lines over years of combined EVNs, summed over all lines, restricted to a
+single line and broken down by line.
+'''
+
+from optparse import OptionParser
+from datetime import date
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import cell_invoice_analyser
+import invoice_database
+import invoice_queries
+from evn_generator import generate_lines, generate_subscribers
+from invoice_constants import SUBSCRIBER_SEPARATORS
+
+
+class NullOutput:
+
+    def write(self, data):
+        pass
+
+
+def create_data_base(data_base, num_months, subscribers, num_lines):
+    '''
+    add a combined EVN of all lines for each of the given number of months
+    '''
+    start = time.time()
+    invoice_database.connect_to_db(data_base)
+    for month in xrange(num_months):
+        billing_date = date(2010 + month // 12, month % 12 + 1, 5)
+        billing_date, warnings = invoice_database.parse_invoice(generate_lines(num_lines,
+                                                                               billing_date=billing_date,
+                                                                               seed=month,
+                                                                               subscribers=subscribers))
+        invoice_database.update_connection_stats(billing_date.connections)
+        invoice_database.session.flush()
+        invoice_database.add_connection_details(billing_date)
+        invoice_database.session.commit()
+    invoice_database.session.close()
+    return time.time() - start
+
+
+def main():
+    cli_parser = OptionParser(usage='%prog [options]')
+    cli_parser.add_option('-m', '--months', dest='months', type='int', default=36,
+                          help='number of months [default: %default]')
+    cli_parser.add_option('-u', '--subscribers', dest='subscribers', type='int', default=300,
+                          help='number of phone lines [default: %default]')
+    cli_parser.add_option('-n', '--lines', dest='lines', type='int', default=10,
+                          help='number of connections per line and month [default: %default]')
+    options, args = cli_parser.parse_args()
+
+    subscribers = [subscriber.translate(None, SUBSCRIBER_SEPARATORS)
+                   for subscriber in generate_subscribers(options.subscribers)]
+    middle = date(2010 + options.months // 24, options.months // 2 % 12 + 1, 1)
+    queries = [('-S', cell_invoice_analyser.show_connection_stats, ()),
+               ('-S --line', cell_invoice_analyser.show_connection_stats, (subscribers[-1],)),
+               ('-S --by-line', cell_invoice_analyser.show_connection_stats, (None, True)),
+               ('-S --since', cell_invoice_analyser.show_connection_stats, (None, False, middle)),
+               ('-S -P', cell_invoice_analyser.show_trend_stats, ()),
+               ('-S -P --line', cell_invoice_analyser.show_trend_stats, (None, subscribers[-1])),
+               ('-S --rolling 12', cell_invoice_analyser.show_trend_stats, (12,)),
+               ('-S --rolling 12 --by-line', cell_invoice_analyser.show_trend_stats, (12, None, True)),
+               ('-m', cell_invoice_analyser.get_month, (middle,)),
+               ('-m --line', cell_invoice_analyser.get_month, (middle, subscribers[-1])),
+               ('-m --by-line', cell_invoice_analyser.get_month, (middle, None, True)),
+               ('-M', cell_invoice_analyser.get_all_months, ()),
+               ('-M --line', cell_invoice_analyser.get_all_months, (None, None, subscribers[-1]))]
+
+    temp_dir = tempfile.mkdtemp()
+    data_base = os.path.join(temp_dir, 'bench.db')
+    try:
+        duration = create_data_base(data_base, options.months, generate_subscribers(options.subscribers),
+                                    options.lines)
+        print '{0} lines over {1} months of {2} connections each, added in {3:.1f}s'.format(options.subscribers,
+                                                                                          options.months,
+                                                                                          options.lines,
+                                                                                          duration)
+
+        connection = invoice_queries.open_data_base(data_base)
+        stdout = sys.stdout
+        try:
+            for name, query, args in queries:
+                sys.stdout = NullOutput()
+                start = time.time()
+                query(connection, *args)
+                elapsed = time.time() - start
+                sys.stdout = stdout
+                print '   {0:<26}: {1:>8.1f}ms'.format(name, elapsed * 1000)
+        finally:
+            sys.stdout = stdout
+            connection.close()
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+'''
+Benchmark of the start-up time of the query commands, which are answered
+without loading the ORM, against the time it takes to merely load it.
+'''
+
+from optparse import OptionParser
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from cStringIO import StringIO
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, BASE_DIR)
+
+import invoice_database
+from evn_generator import generate_invoice
+
+
+ANALYSER = os.path.join(BASE_DIR, 'cell_invoice_analyser.py')
+QUERY_COMMANDS = [['-L'], ['-m', '2012-03'], ['-M'], ['-S']]
+
+
+def create_data_base(data_base, num_lines):
+    '''
+    add a generated invoice to a new data base
+    '''
+    invoice_database.connect_to_db(data_base)
+    billing_date, warnings = invoice_database.parse_invoice(StringIO(generate_invoice(num_lines)))
+    invoice_database.update_connection_stats(billing_date.connections)
+    invoice_database.session.flush()
+    invoice_database.add_connection_details(billing_date)
+    invoice_database.session.commit()
+
+
+def time_command(command, repeat):
+    '''
+    run the given command repeatedly, return the best and the median wall time
+    '''
+    timings = []
+    with open(os.devnull, 'w') as devnull:
+        for run in xrange(repeat):
+            start = time.time()
+            subprocess.check_call(command, stdout=devnull, cwd=BASE_DIR)
+            timings.append(time.time() - start)
+    timings.sort()
+    return timings[0], timings[len(timings) // 2]
+
+
+def main():
+    cli_parser = OptionParser(usage='%prog [options]')
+    cli_parser.add_option('-n', '--lines', dest='lines', type='int', default=1000,
+                          help='number of connection lines in the data base')
+    cli_parser.add_option('-r', '--repeat', dest='repeat', type='int', default=10,
+                          help='number of runs per command')
+    options, args = cli_parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp()
+    data_base = os.path.join(temp_dir, 'bench.db')
+    try:
+        create_data_base(data_base, options.lines)
+
+        commands = [('interpreter', [sys.executable, '-c', 'pass']),
+                    ('load ORM', [sys.executable, '-c', 'import invoice_database'])]
+        commands.extend((' '.join(params), [sys.executable, ANALYSER] + params + [data_base])
+                        for params in QUERY_COMMANDS)
+
+        print '{0:<14} | {1:>9} | {2:>9}'.format('command', 'best', 'median')
+        print '-' * 38
+        for name, command in commands:
+            best, median = time_command(command, options.repeat)
+            print '{0:<14} | {1:>7.1f}ms | {2:>7.1f}ms'.format(name, best * 1000, median * 1000)
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
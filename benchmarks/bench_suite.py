@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+'''
+Benchmark suite timing the stages of adding invoices and each query command
+on synthetic EVNs of growing size. The results are emitted as JSON so they can
+be compared between versions.
+'''
+
+from optparse import OptionParser
+from datetime import date
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, BASE_DIR)
+
+import cell_invoice_analyser
+import invoice_database
+import invoice_queries
+from evn_generator import generate_lines, parse_mix
+
+
+DEFAULT_SIZES = [1000, 100000, 1000000]
+DEFAULT_MONTHS = 12
+
+
+class Timer:
+    '''
+    measure the wall and CPU time of a block
+    '''
+
+    def __enter__(self):
+        self.wall = time.time()
+        self.cpu = time.clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.wall = time.time() - self.wall
+        self.cpu = time.clock() - self.cpu
+
+    def as_dict(self):
+        return {'wall': round(self.wall, 6), 'cpu': round(self.cpu, 6)}
+
+
+class NullOutput:
+    '''
+    swallow the output of the query commands, whether byte or unicode strings
+    '''
+
+    def write(self, data):
+        pass
+
+
+def get_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BASE_DIR,
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_billing_dates(num_months):
+    return [date(2012 + month // 12, month % 12 + 1, 5) for month in xrange(num_months)]
+
+
+def write_invoices(temp_dir, num_connections, num_months, mix):
+    '''
+    generate the EVNs of the given number of months, splitting the connections
+    evenly among them
+    '''
+    invoice_files = []
+    for month, billing_date in enumerate(get_billing_dates(num_months)):
+        num_lines = num_connections // num_months + (month < num_connections % num_months)
+        invoice_files.append(os.path.join(temp_dir, 'evn_{0:%Y-%m}.txt'.format(billing_date)))
+        with open(invoice_files[-1], 'w') as invoice:
+            invoice.writelines(generate_lines(num_lines, mix, billing_date, seed=month))
+    return invoice_files
+
+
+def replay_accumulation(billing_dates):
+    '''
+    feed the parsed connections into fresh connection types again to isolate
+    the summation of prices, fees and chunks
+    '''
+    replicas = []
+    for billing_date in billing_dates:
+        for connection_type in billing_date.connections:
+            if isinstance(connection_type, invoice_database.Calls):
+                replica = invoice_database.Calls(connection_type.type_)
+            else:
+                replica = connection_type.__class__()
+            replica.details.extend(connection_type.details)
+            replicas.append(replica)
+
+    with Timer() as timer:
+        for replica in replicas:
+            replica.update_totals()
+
+    for replica in replicas:
+        invoice_database.session.expunge(replica)
+    return timer
+
+
+def run_queries(data_base, billing_dates):
+    '''
+    time each query command on a read-only connection to the data base
+    '''
+    # connections are dated in the month before their billing date
+    connection_day = date(billing_dates[-1].year - (billing_dates[-1].month == 1),
+                          (billing_dates[-1].month - 2) % 12 + 1, 14)
+    queries = [('list_months', cell_invoice_analyser.list_registered_months, ()),
+               ('get_month', cell_invoice_analyser.get_month, (billing_dates[-1],)),
+               ('get_all_months', cell_invoice_analyser.get_all_months, ()),
+               ('get_day', cell_invoice_analyser.get_day, (connection_day,)),
+               ('top_destinations', cell_invoice_analyser.show_top_destinations, (10,)),
+               ('usage_by_hour', cell_invoice_analyser.show_usage_by_hour, ()),
+               ('show_stats', cell_invoice_analyser.show_connection_stats, ())]
+    timings = {}
+
+    connection = invoice_queries.open_data_base(data_base)
+    stdout = sys.stdout
+    sys.stdout = NullOutput()
+    try:
+        for name, query, args in queries:
+            with Timer() as timer:
+                query(connection, *args)
+            timings[name] = timer.as_dict()
+    finally:
+        sys.stdout = stdout
+        connection.close()
+
+    return timings
+
+
+def run_benchmark(temp_dir, num_connections, num_months, mix):
+    result = {'connections': num_connections, 'months': num_months, 'stages': {}}
+    stages = result['stages']
+    data_base = os.path.join(temp_dir, 'bench_{0}.db'.format(num_connections))
+    billing_dates = []
+
+    invoice_files = write_invoices(temp_dir, num_connections, num_months, mix)
+    invoice_database.connect_to_db(data_base)
+
+    with Timer() as timer:
+        for invoice_file in invoice_files:
+            with open(invoice_file) as invoice:
+                billing_dates.append(invoice_database.parse_invoice(invoice)[0])
+    stages['parse'] = timer.as_dict()
+
+    stages['accumulate'] = replay_accumulation(billing_dates).as_dict()
+
+    with Timer() as timer:
+        for billing_date in billing_dates:
+            invoice_database.update_connection_stats(billing_date.connections)
+        invoice_database.session.flush()
+        for billing_date in billing_dates:
+            invoice_database.add_connection_details(billing_date)
+        invoice_database.session.commit()
+    stages['commit'] = timer.as_dict()
+    billing_dates = [billing_date.date for billing_date in billing_dates]
+    invoice_database.session.close()
+
+    result['queries'] = run_queries(data_base, billing_dates)
+
+    for invoice_file in invoice_files:
+        os.remove(invoice_file)
+    return result
+
+
+def main():
+    cli_parser = OptionParser(usage='%prog [options]')
+    cli_parser.add_option('-n', '--connections', dest='sizes', type='int', action='append',
+                          help='total number of connections (repeatable) '\
+                               '[default: {0}]'.format(', '.join(map(str, DEFAULT_SIZES))))
+    cli_parser.add_option('-m', '--months', dest='months', type='int', default=DEFAULT_MONTHS,
+                          help='number of billing dates to spread the connections '\
+                               'over [default: %default]')
+    cli_parser.add_option('-x', '--mix', dest='mix', metavar='TYPE=WEIGHT,...',
+                          help='relative frequency of the connection types')
+    cli_parser.add_option('-o', '--output', dest='output', metavar='FILE',
+                          help='write the JSON results to FILE instead of stdout')
+    options, args = cli_parser.parse_args()
+
+    try:
+        mix = parse_mix(options.mix) if options.mix else None
+    except ValueError as error:
+        cli_parser.error(str(error))
+
+    results = {'revision': get_revision(),
+               'python': platform.python_version(),
+               'sqlite': sqlite3.sqlite_version,
+               'platform': platform.platform(),
+               'mix': mix,
+               'results': []}
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        for num_connections in options.sizes or DEFAULT_SIZES:
+            results['results'].append(run_benchmark(temp_dir, num_connections, options.months, mix))
+    finally:
+        shutil.rmtree(temp_dir)
+
+    output = open(options.output, 'w') if options.output else sys.stdout
+    try:
+        json.dump(results, output, indent=2, sort_keys=True)
+        output.write('\n')
+    finally:
+        if options.output:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+'''
+Benchmark of the tariff simulator, evaluating a number of random plans over
+years of generated usage.
+'''
+
+from optparse import OptionParser
+from datetime import date
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import invoice_database
+import tariff_simulator
+from invoice_queries import open_data_base
+from evn_generator import generate_lines
+
+
+def create_data_base(data_base, num_months, num_lines):
+    '''
+    add a generated invoice for each of the given number of months
+    '''
+    invoice_database.connect_to_db(data_base)
+    for month in xrange(num_months):
+        billing_date = date(2010 + month // 12, month % 12 + 1, 5)
+        billing_date, warnings = invoice_database.parse_invoice(generate_lines(num_lines,
+                                                                               billing_date=billing_date,
+                                                                               seed=month))
+        invoice_database.update_connection_stats(billing_date.connections)
+        invoice_database.session.flush()
+        invoice_database.add_connection_details(billing_date)
+    invoice_database.session.commit()
+    invoice_database.session.close()
+
+
+def generate_plans(num_plans, seed=0):
+    rand = random.Random(seed)
+    plans = []
+    for index in xrange(num_plans):
+        plans.append({'name': 'plan {0}'.format(index),
+                      'base_fee': rand.choice([2.95, 4.95, 9.95, 19.95, 29.95]),
+                      'rates': {'calls': rand.choice([0.03, 0.05, 0.09, 0.15]),
+                                'SMS': rand.choice([0.05, 0.09, 0.19]),
+                                'GPRS': rand.choice([0.0005, 0.001, 0.0049])},
+                      'included': {'calls': rand.choice([0, 50, 100, 300, None]),
+                                   'SMS': rand.choice([0, 100, None]),
+                                   'GPRS': rand.choice([0, 200 * 1024, 1024 * 1024, None])},
+                      'increments': {'calls': rand.choice([1, 10, 60]),
+                                     'GPRS': rand.choice([1, 10, 100])},
+                      'net': rand.random() < 0.2})
+    return plans
+
+
+def main():
+    cli_parser = OptionParser(usage='%prog [options]')
+    cli_parser.add_option('-m', '--months', dest='months', type='int', default=36,
+                          help='number of months of usage [default: %default]')
+    cli_parser.add_option('-n', '--lines', dest='lines', type='int', default=2000,
+                          help='number of connections per month [default: %default]')
+    cli_parser.add_option('-p', '--plans', dest='plans', type='int', default=500,
+                          help='number of plans [default: %default]')
+    options, args = cli_parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp()
+    data_base = os.path.join(temp_dir, 'bench.db')
+    try:
+        create_data_base(data_base, options.months, options.lines)
+        connection = open_data_base(data_base)
+
+        start = time.time()
+        plans = tariff_simulator.Plans(generate_plans(options.plans))
+        usage = tariff_simulator.load_usage(connection)
+        loaded = time.time()
+        costs = tariff_simulator.simulate(usage, plans)
+        simulated = time.time()
+        connection.close()
+
+        print '{0} plans over {1} months of {2} connections'.format(options.plans, options.months,
+                                                                   options.lines)
+        print '   load usage and plans: {0:>8.1f}ms'.format((loaded - start) * 1000)
+        print '   simulate            : {0:>8.1f}ms'.format((simulated - loaded) * 1000)
+        print '   cheapest plan       : {0} ({1:.2f})'.format(plans.names[costs.sum(axis=1).argmin()],
+                                                            costs.sum(axis=1).min())
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+'''
+Generator of synthetic Klarmobil EVNs (Einzelverbindungsnachweise) as
+`pdftotext -layout` extracts them, matching the parse patterns of the
+connection types in `invoice_database`. They can also be written as minimal
+.pdf files to benchmark the extraction backends.
+'''
+
+from optparse import OptionParser
+from datetime import date
+from bisect import bisect_right
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from invoice_database import ConnectionType
+
+
+LINES_PER_PAGE = 60
+PAGE_HEADER = 'Einzelverbindungsnachweis                                   Seite {0}\n'\
+              'Datum     Uhrzeit   Art    Zielrufnummer   Anbieter   Dauer/Menge   Preis\n'
+# precedes the connections of each line on the invoice of several lines
+SUBSCRIBER_HEADER = 'Rufnummer: {0}\n'
+PROVIDERS = ['Telekom', 'Vodafone', 'E-Plus', 'O2']
+# relative frequency of the connection types
+DEFAULT_MIX = {ConnectionType.FESTNETZ: 2,
+               ConnectionType.NETZEXTERN: 3,
+               ConnectionType.NETZINTERN: 2,
+               ConnectionType.SMS: 2,
+               ConnectionType.INET: 1}
+MAX_CALL_DURATION = 30 * 60
+MAX_INET_QUANTITY = 2000
+# A4 in points, typeset in a standard font that needs no embedding
+PDF_PAGE_WIDTH = 595
+PDF_PAGE_HEIGHT = 842
+PDF_MARGIN = 36
+PDF_FONT_SIZE = 7
+PDF_LEADING = 9
+PDF_LINES_PER_PAGE = (PDF_PAGE_HEIGHT - 2 * PDF_MARGIN) // PDF_LEADING
+
+
+def format_price(net_price):
+    return '{0:.4f}'.format(net_price).replace('.', ',')
+
+
+def generate_subscribers(num_subscribers):
+    return ['0170 {0:07d}'.format(index * 7919 + 1000000) for index in xrange(num_subscribers)]
+
+
+def generate_lines(num_lines, mix=None, billing_date=date(2012, 3, 5), seed=0, subscribers=None):
+    '''
+    yield the lines of an EVN with the given number of connections, whose types
+    are drawn according to their relative frequency in the given mix; given
+    the numbers of several lines, a combined EVN with that many connections per
+    line
+    '''
+    rand = random.Random(seed)
+    mix = mix or DEFAULT_MIX
+    types = sorted(mix)
+    weights = [mix[type_] for type_ in types]
+    month = date(billing_date.year - (billing_date.month == 1), (billing_date.month - 2) % 12 + 1, 1)
+
+    # types are drawn by bisecting the cumulative weights
+    cumulative = []
+    for weight in weights:
+        cumulative.append((cumulative[-1] if cumulative else 0) + weight)
+
+    yield 'Klarmobil GmbH\n'
+    yield 'Rechnungsdatum:   {0:%d.%m.%Y}\n'.format(billing_date)
+
+    for index in xrange(num_lines * len(subscribers or [None])):
+        if subscribers and index % num_lines == 0:
+            yield SUBSCRIBER_HEADER.format(subscribers[index // num_lines])
+        if index % LINES_PER_PAGE == 0:
+            yield PAGE_HEADER.format(index // LINES_PER_PAGE + 1)
+
+        pick = rand.random() * cumulative[-1]
+        type_ = types[bisect_right(cumulative, pick)]
+        stamp = '{0:02d}.{1:%m.%y}   {2:02d}:{3:02d}:{4:02d}'.format(rand.randint(1, 28), month,
+                                                                  rand.randint(0, 23),
+                                                                  rand.randint(0, 59),
+                                                                  rand.randint(0, 59))
+
+        if type_ == ConnectionType.INET:
+            quantity = rand.randint(1, MAX_INET_QUANTITY)
+            chunks = quantity // 100 + 1
+            yield '{0}   GPRS   internet.online   -   {1}:{2:02d}/   {3}   {4}\n'.format(stamp,
+                                                                                 rand.randint(0, 59),
+                                                                                 rand.randint(0, 59),
+                                                                                 quantity,
+                                                                                 format_price(chunks * ConnectionType.FEES[type_]['net']))
+        elif type_ == ConnectionType.SMS:
+            yield '{0}   SMS    0170{1:07d}   {2}   1   {3}\n'.format(stamp,
+                                                                  rand.randint(0, 9999999),
+                                                                  rand.choice(PROVIDERS),
+                                                                  format_price(ConnectionType.FEES[type_]['net']))
+        else:
+            duration = rand.randint(1, MAX_CALL_DURATION)
+            # calls are charged per started minute
+            minutes = (duration + 59) // 60
+            yield '{0}   {1:<4}   0{2}{3:07d}   {4}   {5}:{6:02d}   {7}\n'.format(stamp, type_,
+                                                                         '30' if type_ == ConnectionType.FESTNETZ else '170',
+                                                                         rand.randint(0, 9999999),
+                                                                         rand.choice(PROVIDERS),
+                                                                         duration // 60, duration % 60,
+                                                                         format_price(minutes * ConnectionType.FEES[type_]['net']))
+
+
+def generate_invoice(num_lines, mix=None, billing_date=date(2012, 3, 5), seed=0, subscribers=None):
+    '''
+    assemble an EVN with the given number of connections as a whole
+    '''
+    return ''.join(generate_lines(num_lines, mix, billing_date, seed, subscribers))
+
+
+def write_pdf(lines, output):
+    '''
+    typeset the given lines in Courier, one uncompressed page per
+    `PDF_LINES_PER_PAGE` lines
+    '''
+    lines = ''.join(lines).splitlines()
+    pages = [lines[start:start + PDF_LINES_PER_PAGE]
+             for start in xrange(0, len(lines), PDF_LINES_PER_PAGE)] or [[]]
+    # catalog, page tree and font come first, then each page and its contents
+    objects = ['<< /Type /Catalog /Pages 2 0 R >>',
+               '<< /Type /Pages /Kids [{0}] /Count {1} >>'.format(' '.join('{0} 0 R'.format(4 + 2 * page)
+                                                                           for page in xrange(len(pages))),
+                                                                  len(pages)),
+               '<< /Type /Font /Subtype /Type1 /BaseFont /Courier >>']
+
+    for page_lines in pages:
+        content = 'BT /F1 {0} Tf {1} TL {2} {3} Td\n'.format(PDF_FONT_SIZE, PDF_LEADING, PDF_MARGIN,
+                                                            PDF_PAGE_HEIGHT - PDF_MARGIN)
+        content += ''.join('({0}) Tj T*\n'.format(line.replace('\\', '\\\\')
+                                                       .replace('(', '\\(')
+                                                       .replace(')', '\\)'))
+                           for line in page_lines)
+        content += 'ET'
+        objects.append('<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {0} {1}] '\
+                       '/Resources << /Font << /F1 3 0 R >> >> '\
+                       '/Contents {2} 0 R >>'.format(PDF_PAGE_WIDTH, PDF_PAGE_HEIGHT,
+                                                     len(objects) + 2))
+        objects.append('<< /Length {0} >>\nstream\n{1}\nendstream'.format(len(content) + 1,
+                                                                          content))
+
+    offsets = []
+    output.write('%PDF-1.4\n')
+    position = len('%PDF-1.4\n')
+    for number, body in enumerate(objects, 1):
+        offsets.append(position)
+        chunk = '{0} 0 obj\n{1}\nendobj\n'.format(number, body)
+        output.write(chunk)
+        position += len(chunk)
+
+    output.write('xref\n0 {0}\n0000000000 65535 f \n'.format(len(objects) + 1))
+    for offset in offsets:
+        output.write('{0:010d} 00000 n \n'.format(offset))
+    output.write('trailer\n<< /Size {0} /Root 1 0 R >>\n'\
+                 'startxref\n{1}\n%%EOF\n'.format(len(objects) + 1, position))
+
+
+def parse_mix(mix):
+    '''
+    parse a mix given as `TYPE=WEIGHT,...`, e.g. `NX=3,SMS=1,GPRS=1`
+    '''
+    parsed_mix = {}
+    for entry in mix.split(','):
+        type_, weight = entry.split('=')
+        if type_ not in ConnectionType.FEES:
+            raise ValueError('unknown connection type \'{0}\''.format(type_))
+        parsed_mix[type_] = float(weight)
+    return parsed_mix
+
+
+def main():
+    cli_parser = OptionParser(usage='%prog [options] [output_file]')
+    cli_parser.add_option('-n', '--lines', dest='lines', type='int', default=1000,
+                          help='number of connection lines [default: %default]')
+    cli_parser.add_option('-x', '--mix', dest='mix', metavar='TYPE=WEIGHT,...',
+                          help='relative frequency of the connection types')
+    cli_parser.add_option('-b', '--billing-date', dest='billing_date', metavar='DATE',
+                          default='2012-03-05', help='date of the invoice [default: %default]')
+    cli_parser.add_option('-s', '--seed', dest='seed', type='int', default=0,
+                          help='seed of the random connections [default: %default]')
+    cli_parser.add_option('-u', '--subscribers', dest='subscribers', type='int', default=0,
+                          help='write a combined EVN of this many phone lines, with the '\
+                               'given number of connections each')
+    cli_parser.add_option('-p', '--pdf', dest='pdf', action='store_true', default=False,
+                          help='write a .pdf file rather than the extracted text')
+    options, args = cli_parser.parse_args()
+
+    try:
+        mix = parse_mix(options.mix) if options.mix else None
+        billing_date = date(*map(int, options.billing_date.split('-')))
+    except ValueError as error:
+        cli_parser.error(str(error))
+
+    subscribers = generate_subscribers(options.subscribers) if options.subscribers else None
+    lines = generate_lines(options.lines, mix, billing_date, options.seed, subscribers)
+    output = open(args[0], 'wb' if options.pdf else 'w') if args else sys.stdout
+    try:
+        if options.pdf:
+            write_pdf(lines, output)
+        else:
+            output.writelines(lines)
+    finally:
+        if args:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
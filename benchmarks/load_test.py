@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+'''
+Load test of the query server on localhost, reporting the p50 and p99 latency
+of each endpoint. The server is started on a generated data base, or on a
+given one, and queried by a number of concurrent clients keeping their
+connections open. Invoices can be added while it is under load, to check
+that adding does not fail on locks and that the cached results are dropped.
+'''
+
+from optparse import OptionParser
+from datetime import date
+import httplib
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, BASE_DIR)
+
+import invoice_database
+from evn_generator import generate_lines, generate_subscribers
+from invoice_constants import SUBSCRIBER_SEPARATORS
+
+
+ANALYSER = os.path.join(BASE_DIR, 'cell_invoice_analyser.py')
+SERVER_START_TIMEOUT = 30
+
+
+def add_month(month, subscribers, num_lines):
+    billing_date = date(2010 + month // 12, month % 12 + 1, 5)
+    billing_date, warnings = invoice_database.parse_invoice(generate_lines(num_lines,
+                                                                           billing_date=billing_date,
+                                                                           seed=month,
+                                                                           subscribers=subscribers))
+    invoice_database.update_connection_stats(billing_date.connections)
+    invoice_database.session.flush()
+    invoice_database.add_connection_details(billing_date)
+    invoice_database.session.commit()
+
+
+def get_free_port():
+    probe = socket.socket()
+    try:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+    finally:
+        probe.close()
+
+
+def wait_for_server(port):
+    deadline = time.time() + SERVER_START_TIMEOUT
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError('The server did not start within {0}s'.format(SERVER_START_TIMEOUT))
+
+
+def get_paths(num_months, subscribers):
+    '''
+    the requests to draw from, by endpoint
+    '''
+    months = ['{0}-{1:02d}'.format(2010 + month // 12, month % 12 + 1) for month in xrange(num_months)]
+    line = subscribers[0].translate(None, SUBSCRIBER_SEPARATORS) if subscribers else ''
+    return [('/months', ['/months']),
+            ('/range', ['/range/{0}/{1}'.format(months[0], month) for month in months]),
+            ('/month', ['/month/{0}'.format(month) for month in months]),
+            ('/month?line', ['/month/{0}?line={1}'.format(month, line) for month in months]),
+            ('/month?by_line', ['/month/{0}?by_line=1'.format(month) for month in months]),
+            ('/statistics', ['/statistics']),
+            ('/statistics?line', ['/statistics?line={0}'.format(line)]),
+            ('/statistics?by_line', ['/statistics?by_line=1'])]
+
+
+def run_client(port, requests, results):
+    '''
+    issue the given requests over a single connection, record their latencies
+    '''
+    connection = httplib.HTTPConnection('127.0.0.1', port)
+    try:
+        for endpoint, path in requests:
+            start = time.time()
+            try:
+                connection.request('GET', path)
+                response = connection.getresponse()
+                response.read()
+                status, cache = response.status, response.getheader('X-Cache')
+            except (httplib.HTTPException, socket.error) as error:
+                connection.close()
+                status, cache = str(error), None
+            results.append((endpoint, time.time() - start, status, cache))
+    finally:
+        connection.close()
+
+
+def run_ingest(month, num_months, subscribers, num_lines, interval, errors):
+    for index in xrange(num_months):
+        time.sleep(interval)
+        try:
+            add_month(month + index, subscribers, num_lines)
+        except Exception as error:
+            invoice_database.session.rollback()
+            errors.append(error)
+
+
+def percentile(latencies, fraction):
+    return latencies[min(int(round(fraction * (len(latencies) - 1))), len(latencies) - 1)]
+
+
+def report(results):
+    endpoints = []
+    for endpoint, latency, status, cache in results:
+        if endpoint not in endpoints:
+            endpoints.append(endpoint)
+
+    print '{0:<20} | {1:>8} | {2:>9} | {3:>9} | {4:>6} | {5:>6}'.format('endpoint', 'requests', 'p50',
+                                                                      'p99', 'hits', 'errors')
+    print '-' * 72
+    for endpoint in sorted(endpoints) + [None]:
+        selected = [result for result in results if endpoint is None or result[0] == endpoint]
+        latencies = sorted(latency for name, latency, status, cache in selected)
+        print '{0:<20} | {1:>8} | {2:>7.2f}ms | {3:>7.2f}ms | {4:>5.1f}% | {5:>6}'.format(endpoint or 'all',
+                                                                                   len(selected),
+                                                                                   percentile(latencies, 0.5) * 1000,
+                                                                                   percentile(latencies, 0.99) * 1000,
+                                                                                   100.0 * sum(1 for result in selected
+                                                                                               if result[3] == 'hit') / len(selected),
+                                                                                   sum(1 for result in selected
+                                                                                       if result[2] != 200))
+
+
+def main():
+    cli_parser = OptionParser(usage='%prog [options] [data_base_file]')
+    cli_parser.add_option('-m', '--months', dest='months', type='int', default=24,
+                          help='number of months of the generated data base [default: %default]')
+    cli_parser.add_option('-u', '--subscribers', dest='subscribers', type='int', default=20,
+                          help='number of phone lines of the generated data base [default: %default]')
+    cli_parser.add_option('-n', '--lines', dest='lines', type='int', default=20,
+                          help='number of connections per line and month [default: %default]')
+    cli_parser.add_option('-c', '--concurrency', dest='concurrency', type='int', default=8,
+                          help='number of concurrent clients [default: %default]')
+    cli_parser.add_option('-r', '--requests', dest='requests', type='int', default=2000,
+                          help='total number of requests [default: %default]')
+    cli_parser.add_option('-i', '--ingest', dest='ingest', type='int', default=0,
+                          help='number of months to add to the generated data base while it is '\
+                               'under load [default: %default]')
+    options, args = cli_parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp()
+    server = None
+    subscribers = generate_subscribers(options.subscribers) if options.subscribers > 1 else None
+    try:
+        if args:
+            data_base = args[0]
+            options.ingest = 0
+        else:
+            data_base = os.path.join(temp_dir, 'load.db')
+            invoice_database.connect_to_db(data_base)
+            for month in xrange(options.months):
+                add_month(month, subscribers, options.lines)
+
+        port = get_free_port()
+        with open(os.devnull, 'w') as devnull:
+            server = subprocess.Popen([sys.executable, ANALYSER, '--serve', str(port), data_base],
+                                      stdout=devnull)
+        wait_for_server(port)
+
+        rand = random.Random(0)
+        paths = get_paths(options.months, subscribers)
+        requests = []
+        for index in xrange(options.requests):
+            endpoint, endpoint_paths = rand.choice(paths)
+            requests.append((endpoint, rand.choice(endpoint_paths)))
+
+        results = []
+        errors = []
+        threads = [threading.Thread(target=run_client,
+                                    args=(port, requests[index::options.concurrency], results))
+                   for index in xrange(options.concurrency)]
+        if options.ingest:
+            threads.append(threading.Thread(target=run_ingest,
+                                            args=(options.months, options.ingest, subscribers,
+                                                  options.lines, 0.2, errors)))
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+
+        print '{0} requests by {1} clients in {2:.2f}s ({3:.0f} requests/s)'.format(len(results),
+                                                                                  options.concurrency,
+                                                                                  elapsed,
+                                                                                  len(results) / elapsed)
+        report(results)
+
+        if options.ingest:
+            connection = httplib.HTTPConnection('127.0.0.1', port)
+            connection.request('GET', '/months')
+            num_months = len(json.load(connection.getresponse()))
+            connection.close()
+            print '\nadded {0} months while under load, {1} failed, the server lists {2} of '\
+                  '{3} months'.format(options.ingest, len(errors), num_months,
+                                      options.months + options.ingest)
+            for error in errors:
+                print '   {0}'.format(error)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+        invoice_database.session.close()
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
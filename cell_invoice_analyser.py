@@ -2,196 +2,27 @@
 
 from optparse import OptionParser, OptionGroup
 import sys
-import subprocess
-import re
+import os
+import sqlite3
 from datetime import datetime, date
-from elixir import *
-from sqlalchemy import asc, func
-from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
-from numpy import std
+from math import sqrt
 
+from instrumentation import instrumentation, CountingConnection
+from invoice_constants import SUBSCRIBER_SEPARATORS, SMS, INET
+from invoice_queries import open_data_base, to_euros, query_months, query_months_by_line, \
+                            format_subscriber, fetch_connection_stats, query_connection_stats, \
+                            query_line_stats, format_selection, STATISTICS_LABELS, CONNECTION_UNITS
 
-NUM_EXPECTED_CLI_ARGS = 1
-INPUT_FILE_PLACEHOLDER = '%%INPUT_FILE%%'
-EXTRACTION_COMMAND_TEMPLATE = ['pdftotext', '-layout', INPUT_FILE_PLACEHOLDER, '-']
-VAT_FACTOR = 1.19
-
-
-class BillingDate(Entity):
-    using_options(tablename='billing_date', inheritance='multi')
-
-    date = Field(Date, primary_key=True)
-    connections = OneToMany('ConnectionType')
-
-    def __init__(self, billing_date):
-        self.date = billing_date
-        self.calls = ()
-
-    def __str__(self):
-        return str(self.date)
-
-
-class ConnectionType(Entity):
-    FESTNETZ = 'NA'
-    NETZEXTERN = 'NX'
-    NETZINTERN = 'PI'
-    SMS = 'SMS'
-    INET = 'GPRS'
-
-    FEES = { FESTNETZ: {'net': 0.00, 'gross': 0.00},
-             NETZEXTERN: {'net': 0.00, 'gross': 0.00},
-             NETZINTERN: {'net': 0.00, 'gross': 0.00},
-             SMS: {'net': 0.00, 'gross': 0.00},
-             INET: {'net': 0.00, 'gross': 0.00} }
-
-    # set gross prices
-    FEES[FESTNETZ]['gross'] = 0.09
-    FEES[NETZEXTERN]['gross'] = 0.09
-    FEES[NETZINTERN]['gross'] = 0.09
-    FEES[SMS]['gross'] = 0.09
-    FEES[INET]['gross'] = 0.49
-
-    # calculate net fees from given gross values
-    FEES[FESTNETZ]['net'] = FEES[FESTNETZ]['gross'] / VAT_FACTOR
-    FEES[NETZEXTERN]['net'] = FEES[NETZEXTERN]['gross'] / VAT_FACTOR
-    FEES[NETZINTERN]['net'] = FEES[NETZINTERN]['gross'] / VAT_FACTOR
-    FEES[SMS]['net'] = FEES[SMS]['gross'] / VAT_FACTOR
-    FEES[INET]['net'] = FEES[INET]['gross'] / VAT_FACTOR
-
-
-    using_options(tablename='connection_type', inheritance='multi')
-
-    type_ = Field(String(4), primary_key=True)
-    amount = Field(Integer)
-    net = Field(Float)
-    gross = Field(Float)
-    date = ManyToOne('BillingDate', primary_key=True)
-
-
-    def __init__(self, connection_type):
-        self.type_ = connection_type
-        self.parse_pattern = ''
-        self.amount = 0
-        self.net = 0.0
-        self.gross = 0.0
-
-    def get_parse_pattern(self):
-        return self.parse_pattern
-
-
-    def add_connections(self, connections):
-        for parsed_price in connections:
-            self._add_connection(float(parsed_price.replace(',', '.')))
-
-
-    def _add_connection(self, net_price):
-        self.net += net_price
-        self.gross += net_price * VAT_FACTOR
-        self.amount += int(round(net_price / ConnectionType.FEES[self.type_]['net']))
-
-
-class Calls(ConnectionType):
-
-    using_options(tablename='calls', inheritance='multi')
-
-    def __init__(self, call_type):
-        super(Calls, self).__init__(call_type)
-        self.parse_pattern = '%(date)s +%(time)s +%(type)s +%(destNumber)s +%(destProvider)s +%(duration)s +(%(price)s)' % {'date': '\d{2}\.\d{2}\.\d{2}',
-                                     'time': '\d{2}:\d{2}:\d{2}',
-                                     'type': self.type_,
-                                     'destNumber': '\d+',
-                                     'destProvider': '\S+',
-                                     'duration': '\d+:\d{2}',
-                                     'price': '\d+,\d{4}'}
-
-
-    def __str__(self):
-        return u"{0}\t{1} min\t| {2}\u20AC ({3}\u20AC)".format(self.type_,
-                                                              self.amount,
-                                                              self.net,
-                                                              self.gross).encode('utf-8')
-
-class TextMessages(ConnectionType):
-
-    using_options(tablename='text_messages', inheritance='multi')
 
-    def __init__(self):
-        super(TextMessages, self).__init__(ConnectionType.SMS)
-        self.parse_pattern = '%(date)s +%(time)s +%(type)s +%(destNumber)s +%(destProvider)s +%(quantity)s +(%(price)s)' % {'date': '\d{2}\.\d{2}\.\d{2}',
-                                     'time': '\d{2}:\d{2}:\d{2}',
-                                     'type': self.type_,
-                                     'destNumber': '\d+',
-                                     'destProvider': '\S+',
-                                     'quantity': '\d+',
-                                     'price': '\d+,\d{4}'}
-
-
-    def __str__(self):
-        return u"{0}\t{1} SMS\t| {2}\u20AC ({3}\u20AC)".format(self.type_,
-                                                              self.amount,
-                                                              self.net,
-                                                              self.gross).encode('utf-8')
-
-
-class MobileWebConnections(ConnectionType):
-
-    using_options(tablename='mobile_web_connections', inheritance='multi')
-
-    # klarmobil charges for 100KB chunks
-    INET_CHUNK_SIZE = 100
-
-    def __init__(self):
-        super(MobileWebConnections, self).__init__(ConnectionType.INET)
-        self.parse_pattern = '%(date)s +%(time)s +%(type)s +%(gateway)s +- +%(duration)s/ +(%(quantity)s) +(%(price)s)' % {'date': '\d{2}\.\d{2}\.\d{2}',
-                                     'time': '\d{2}:\d{2}:\d{2}',
-                                     'type': self.type_,
-                                     'gateway': 'internet.online',
-                                     'duration': '\d+:\d{2}',
-                                     'quantity': '\d+',
-                                     'price': '\d+,\d{4}'}
-
-    def __str__(self):
-        return u"{0}\t{1} kB\t| {2}\u20AC ({3}\u20AC)".format(self.type_,
-                                                              self.amount,
-                                                              self.net,
-                                                              self.gross).encode('utf-8')
-
-
-
-    def add_connections(self, connections):
-            for amount, price in connections:
-                self._add_connection(int(amount), float(price.replace(',', '.')))
-
-
-    def _add_connection(self, amount, net_price):
-        self.net += net_price
-        self.gross += net_price * VAT_FACTOR
-        self.amount += amount + (MobileWebConnections.INET_CHUNK_SIZE - (amount % MobileWebConnections.INET_CHUNK_SIZE))
-
-
-class InvoiceParser:
-
-    def __init__(self, extracted_text):
-        self.invoice = extracted_text
-
-    def extract_rechnungsdatum(self):
-        match = re.search('Rechnungsdatum: +(\d{2})\.(\d{2})\.(\d{4})', self.invoice)
-        if not match:
-            raise LookupError('Could not extract the date of invoice!')
-        else:
-            return date(int(match.group(3)), int(match.group(2)), int(match.group(1)))
-
-
-    def extract_connections(self, connection_type):
-        '''
-        parse the stats for the given connection type from the extracted text
-        '''
-        connections = re.findall(connection_type.get_parse_pattern(), self.invoice, re.M)
-        if not connections:
-            raise UserWarning('No connections of type {0}!'.format(connection_type.type_))
-        else:
-            connection_type.add_connections(connections)
+NUM_EXPECTED_CLI_ARGS = 1
+WATCH_INTERVAL = 60
+EXTRACTION_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'celina')
+EXTRACTION_CACHE_SIZE = 256 * 1024 * 1024
+# backends extracting the text of invoices, see `invoice_database.EXTRACTORS`
+EXTRACTORS = ['pdftotext', 'pdfminer']
+# number of the cheapest plans whose costs are broken down by month
+TARIFF_COLUMNS = 5
+SERVER_ADDRESS = '127.0.0.1'
 
 
 def parse_commandline_parameters(given_params, num_expected_args):
@@ -218,6 +49,34 @@ def parse_commandline_parameters(given_params, num_expected_args):
     add_group.add_option('-a', '--add-invoice', dest='invoice_file',
                          metavar='FILE', help='add invoice FILE to the '\
                                               'data base')
+    add_group.add_option('-A', '--add-invoices', dest='invoice_dir',
+                         metavar='DIR', help='add all invoices in DIR (or '\
+                                             'matching the glob pattern DIR) '\
+                                             'to the data base, parsing them '\
+                                             'in parallel')
+    add_group.add_option('-W', '--watch', dest='watch_dir',
+                         metavar='DIR', help='keep adding new and changed '\
+                                             'invoices in DIR (or matching '\
+                                             'the glob pattern DIR) until '\
+                                             'interrupted')
+    add_group.add_option('--interval', dest='interval', metavar='SECONDS',
+                         type='int', help='look for new invoices every '\
+                                          'SECONDS when watching '\
+                                          '[default: %default]')
+    add_group.add_option('--cache-dir', dest='cache_dir', metavar='DIR',
+                         help='cache extracted invoice texts in DIR '\
+                              '[default: %default]')
+    add_group.add_option('--cache-size', dest='cache_size', metavar='MB',
+                         type='int', help='evict the least recently used '\
+                                          'extracted texts beyond MB '\
+                                          'megabytes [default: %default]')
+    add_group.add_option('--no-cache', dest='no_cache', action='store_true',
+                         help='always extract the text of invoices')
+    add_group.add_option('--extractor', dest='extractor', type='choice',
+                         choices=EXTRACTORS, metavar='BACKEND',
+                         help='extract the text of invoices with BACKEND, one '\
+                              'of {0} (the latter requires the pdfminer '\
+                              'package) [default: %default]'.format(', '.join(EXTRACTORS)))
 
     #   analysing data
     analysis_group = OptionGroup(cli_parser, 'Analysing data')
@@ -226,6 +85,40 @@ def parse_commandline_parameters(given_params, num_expected_args):
                                                      'calculated over all '\
                                                      'registered connection '\
                                                      'data.')
+    analysis_group.add_option('--since', dest='since',
+                           metavar='MONTH', help='restrict statistics to the '\
+                                                 'billing dates from MONTH on')
+    analysis_group.add_option('--until', dest='until',
+                           metavar='MONTH', help='restrict statistics to the '\
+                                                 'billing dates through MONTH')
+    analysis_group.add_option('--rolling', dest='rolling',
+                           metavar='N', type='int', help='display statistics and '\
+                                                         'percentiles over each '\
+                                                         'N consecutive billing '\
+                                                         'dates (requires numpy, '\
+                                                         'see `trend_statistics`)')
+    analysis_group.add_option('-P', '--percentiles', dest='percentiles',
+                           action='store_true', help='also display the 50th, '\
+                                                     '90th and 99th percentiles '\
+                                                     'of the monthly usage '\
+                                                     '(requires numpy, see '\
+                                                     '`trend_statistics`)')
+    analysis_group.add_option('-T', '--simulate-tariffs', dest='tariff_file',
+                           metavar='FILE', help='compute the costs of the '\
+                                                'plans described in the JSON '\
+                                                'FILE for all registered '\
+                                                'months, each line on a plan '\
+                                                'of its own (requires numpy, '\
+                                                'see `tariff_simulator`)')
+    analysis_group.add_option('--rebuild-stats', dest='rebuild_stats',
+                           action='store_true', help='recompute the cached '\
+                                                     'statistics from all '\
+                                                     'registered connection '\
+                                                     'data')
+    analysis_group.add_option('--check-stats', dest='check_stats',
+                           action='store_true', help='verify the cached '\
+                                                     'statistics against a '\
+                                                     'full recomputation')
 
     #   inspecting data
     inspection_group = OptionGroup(cli_parser, 'Inspecting data')
@@ -233,6 +126,13 @@ def parse_commandline_parameters(given_params, num_expected_args):
                            metavar='MONTH', help='display the data registered '\
                                                  'for the given MONTH '\
                                                  '[e.g.: \'{0:%Y-%m}\']'.format(datetime.today()))
+    inspection_group.add_option('-r', '--get-range', dest='month_range',
+                           nargs=2, metavar='FIRST LAST', help='display the '\
+                                                               'data for all '\
+                                                               'billing dates '\
+                                                               'from month '\
+                                                               'FIRST through '\
+                                                               'month LAST')
     inspection_group.add_option('-M', '--get-all-months', dest='all_months',
                            action='store_true', help='display the data for '\
                                                      'all registered billing '\
@@ -240,15 +140,95 @@ def parse_commandline_parameters(given_params, num_expected_args):
     inspection_group.add_option('-L', '--list-months', dest='list_months',
                            action='store_true', help='list the dates of all '\
                                                      'registered months')
+    inspection_group.add_option('--list-lines', dest='list_lines',
+                           action='store_true', help='list the numbers of all '\
+                                                     'registered phone lines')
+    inspection_group.add_option('-d', '--get-day', dest='day',
+                           metavar='DAY', help='display the individual '\
+                                               'connections of the given DAY '\
+                                               '[e.g.: \'{0:%Y-%m-%d}\']'.format(datetime.today()))
+    inspection_group.add_option('-t', '--top-destinations', dest='top_destinations',
+                           metavar='N', type='int', help='display the N most '\
+                                                         'frequent destinations '\
+                                                         'of calls and short '\
+                                                         'messages')
+    inspection_group.add_option('-H', '--usage-by-hour', dest='usage_by_hour',
+                           action='store_true', help='display the usage of '\
+                                                     'all connection types by '\
+                                                     'hour of the day')
+    #   selecting lines
+    lines_group = OptionGroup(cli_parser, 'Selecting lines',
+                              'Statistics and months are summed over all phone '\
+                              'lines of the account by default.')
+    lines_group.add_option('-l', '--line', dest='subscriber',
+                           metavar='NUMBER', help='restrict statistics, '\
+                                                  'months and simulated '\
+                                                  'tariffs to the phone line '\
+                                                  'NUMBER')
+    lines_group.add_option('--by-line', dest='by_line',
+                           action='store_true', help='break statistics and '\
+                                                     'months down by phone line')
+
+    #   exporting data
+    export_group = OptionGroup(cli_parser, 'Exporting data')
+    export_group.add_option('-E', '--export', dest='export_dir',
+                           metavar='DIR', help='export billing dates and '\
+                                               'connections as NumPy columns '\
+                                               'to DIR, appending only the '\
+                                               'billing dates added since the '\
+                                               'last export (requires numpy, '\
+                                               'see `columnar_export`)')
+
+    #   serving data
+    serve_group = OptionGroup(cli_parser, 'Serving data')
+    serve_group.add_option('--serve', dest='port', metavar='PORT',
+                           type='int', help='answer queries for months, '\
+                                            'ranges and statistics as JSON '\
+                                            'over HTTP on PORT until '\
+                                            'interrupted (see `query_server`)')
+    serve_group.add_option('--bind', dest='address', metavar='ADDRESS',
+                           help='serve on ADDRESS [default: %default]')
+
+    #   diagnostics
+    diagnostics_group = OptionGroup(cli_parser, 'Diagnostics')
+    diagnostics_group.add_option('--timings', dest='timings',
+                           action='store_true', help='report wall and CPU '\
+                                                     'time of each stage, '\
+                                                     'matched lines, SQL '\
+                                                     'statements and peak '\
+                                                     'memory usage')
+    diagnostics_group.add_option('--timings-json', dest='timings_json',
+                           metavar='FILE', help='write the timings as JSON '\
+                                                'to FILE (\'-\' for stdout)')
+    diagnostics_group.add_option('--profile', dest='profile',
+                           metavar='FILE', help='dump cProfile statistics of '\
+                                                'the command to FILE')
     #   register groups
     cli_parser.add_option_group(add_group)
     cli_parser.add_option_group(analysis_group)
     cli_parser.add_option_group(inspection_group)
+    cli_parser.add_option_group(lines_group)
+    cli_parser.add_option_group(export_group)
+    cli_parser.add_option_group(serve_group)
+    cli_parser.add_option_group(diagnostics_group)
 
     #   set defaults
+    cli_parser.set_defaults(cache_dir=EXTRACTION_CACHE_DIR)
+    cli_parser.set_defaults(cache_size=EXTRACTION_CACHE_SIZE // (1024 * 1024))
+    cli_parser.set_defaults(no_cache=False)
+    cli_parser.set_defaults(interval=WATCH_INTERVAL)
+    cli_parser.set_defaults(extractor=EXTRACTORS[0])
     cli_parser.set_defaults(all_months=False)
     cli_parser.set_defaults(list_months=False)
+    cli_parser.set_defaults(list_lines=False)
+    cli_parser.set_defaults(by_line=False)
+    cli_parser.set_defaults(address=SERVER_ADDRESS)
     cli_parser.set_defaults(show_stats=False)
+    cli_parser.set_defaults(percentiles=False)
+    cli_parser.set_defaults(rebuild_stats=False)
+    cli_parser.set_defaults(check_stats=False)
+    cli_parser.set_defaults(usage_by_hour=False)
+    cli_parser.set_defaults(timings=False)
 
     # parse cli parameters
     parsed_options, parsed_args = cli_parser.parse_args(given_params)
@@ -256,16 +236,36 @@ def parse_commandline_parameters(given_params, num_expected_args):
     # validate params
     if len(parsed_args) != num_expected_args:
         cli_parser.error('incorrect number of arguments')
-    if parsed_options.month:
+    def parse_month(month):
         try:
-            year = int(parsed_options.month[0:4])
-            month = int(parsed_options.month[5:7])
-            date_ = date(year, month, 1)
-            parsed_options.month = date_
+            year = int(month[0:4])
+            month_ = int(month[5:7])
+            return date(year, month_, 1)
         except Exception as error:
             cli_parser.error('\'{0}\' is not a valid year-month '\
-                             'combination: {1}'.format(parsed_options.month,
-                                                       error))
+                             'combination: {1}'.format(month, error))
+
+    if parsed_options.month:
+        parsed_options.month = parse_month(parsed_options.month)
+    if parsed_options.month_range:
+        parsed_options.month_range = tuple(parse_month(month)
+                                           for month in parsed_options.month_range)
+    if parsed_options.since:
+        parsed_options.since = parse_month(parsed_options.since)
+    if parsed_options.until:
+        parsed_options.until = parse_month(parsed_options.until)
+    if parsed_options.rolling is not None and parsed_options.rolling < 1:
+        cli_parser.error('option --rolling requires at least 1 billing date')
+    if parsed_options.subscriber is not None:
+        if parsed_options.by_line:
+            cli_parser.error('options --line and --by-line are mutually exclusive')
+        parsed_options.subscriber = parsed_options.subscriber.translate(None, SUBSCRIBER_SEPARATORS)
+    if parsed_options.day:
+        try:
+            parsed_options.day = datetime.strptime(parsed_options.day, '%Y-%m-%d').date()
+        except Exception as error:
+            cli_parser.error('\'{0}\' is not a valid date: {1}'.format(parsed_options.day,
+                                                                     error))
 
     # add mandatory data base to options for improved lookup ability
     parsed_options.data_base = parsed_args[0]
@@ -282,211 +282,468 @@ def main():
     '''
 
     cli_params = None
+    profiler = None
 
     # parse cli parameters
     cli_params = parse_commandline_parameters(sys.argv[1:], NUM_EXPECTED_CLI_ARGS)
     input_file = sys.argv[1]
 
+    instrumentation.enabled = cli_params.timings or bool(cli_params.timings_json)
+    if cli_params.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        # only adding data and maintaining the data base requires the ORM
+        if cli_params.invoice_file or cli_params.invoice_dir or cli_params.watch_dir or \
+                cli_params.rebuild_stats or cli_params.check_stats:
+            update_data_base(cli_params)
+        elif cli_params.port is not None:
+            serve_data_base(cli_params)
+        else:
+            query_data_base(cli_params)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(cli_params.profile)
+        report_timings(cli_params)
+
+
+def report_timings(cli_params):
+    '''
+    print the collected timings and/or write them as JSON
+    '''
+    if cli_params.timings:
+        print '\n{0}'.format(instrumentation.report())
+
+    if cli_params.timings_json:
+        import json
+        if cli_params.timings_json == '-':
+            json.dump(instrumentation.as_dict(), sys.stdout, indent=2)
+            print
+        else:
+            with open(cli_params.timings_json, 'w') as timings_file:
+                json.dump(instrumentation.as_dict(), timings_file, indent=2)
+
+
+def update_data_base(cli_params):
+    '''
+    add data to or maintain the data base through its ORM model
+    '''
+    with instrumentation.stage('load orm'):
+        import invoice_database
+
+    cache = None
+
     # connect to data base
-    connect_to_db(cli_params.data_base)
+    with instrumentation.stage('connect'):
+        invoice_database.connect_to_db(cli_params.data_base)
+
+    if not cli_params.no_cache:
+        cache = invoice_database.ExtractionCache(cli_params.cache_dir,
+                                                 cli_params.cache_size * 1024 * 1024)
+    if cli_params.invoice_file or cli_params.invoice_dir or cli_params.watch_dir:
+        try:
+            invoice_database.get_extractor(cli_params.extractor)
+        except ImportError as error:
+            print 'ERROR: Extraction backend \'{0}\' is not available: {1}'.format(cli_params.extractor,
+                                                                                 error)
+            raise SystemExit(1)
 
     try:
         if cli_params.invoice_file:
             print 'Adding invoice \'{0}\' to data base \'{1}\', '\
                   'ignoring potential querying parameters...'.format(cli_params.invoice_file,
                                                                      cli_params.data_base)
-            add_invoice(cli_params.invoice_file)
-        elif cli_params.month:
-            print 'Fetching data for \'{0:%Y-%m}\'...'.format(cli_params.month)
-            get_month(cli_params.month)
-        elif cli_params.all_months:
-            print 'Fetching data for all months...'
-            get_all_months()
-        elif cli_params.list_months:
-            print 'Fetching data on registered months...'
-            list_registered_months()
-        elif cli_params.show_stats:
-            print 'Calculating statistics...'
-            show_connection_stats()
+            invoice_database.add_invoice(cli_params.invoice_file, cache,
+                                         cli_params.extractor)
+        elif cli_params.invoice_dir:
+            print 'Adding invoices from \'{0}\' to data base \'{1}\', '\
+                  'ignoring potential querying parameters...'.format(cli_params.invoice_dir,
+                                                                     cli_params.data_base)
+            invoice_database.add_invoices(cli_params.invoice_dir, cache,
+                                          cli_params.extractor)
+        elif cli_params.watch_dir:
+            invoice_database.watch_invoices(cli_params.watch_dir, cli_params.interval,
+                                            cache, cli_params.extractor)
+        elif cli_params.rebuild_stats:
+            print 'Rebuilding statistics...'
+            invoice_database.rebuild_connection_stats()
+        elif cli_params.check_stats:
+            print 'Checking statistics...'
+            invoice_database.check_connection_stats()
+    finally:
+        # clean up
+        invoice_database.session.close()
+
+
+def query_data_base(cli_params):
+    '''
+    answer queries on a plain, read-only connection to the data base
+    '''
+    with instrumentation.stage('connect'):
+        connection = open_data_base(cli_params.data_base)
+    if instrumentation.enabled:
+        connection = CountingConnection(connection, instrumentation)
+
+    try:
+        with instrumentation.stage('query'):
+            if cli_params.month:
+                print 'Fetching data for \'{0:%Y-%m}\'...'.format(cli_params.month)
+                get_month(connection, cli_params.month, cli_params.subscriber,
+                          cli_params.by_line)
+            elif cli_params.month_range:
+                print 'Fetching data from \'{0[0]:%Y-%m}\' through \'{0[1]:%Y-%m}\'...'.format(cli_params.month_range)
+                get_all_months(connection, cli_params.month_range[0], cli_params.month_range[1],
+                               cli_params.subscriber, cli_params.by_line)
+            elif cli_params.all_months:
+                print 'Fetching data for all months...'
+                get_all_months(connection, subscriber=cli_params.subscriber,
+                               by_line=cli_params.by_line)
+            elif cli_params.list_months:
+                print 'Fetching data on registered months...'
+                list_registered_months(connection)
+            elif cli_params.list_lines:
+                print 'Fetching data on registered lines...'
+                list_registered_lines(connection)
+            elif cli_params.day:
+                print 'Fetching connections for \'{0:%Y-%m-%d}\'...'.format(cli_params.day)
+                get_day(connection, cli_params.day)
+            elif cli_params.top_destinations:
+                print 'Fetching the {0} most frequent destinations...'.format(cli_params.top_destinations)
+                show_top_destinations(connection, cli_params.top_destinations)
+            elif cli_params.usage_by_hour:
+                print 'Calculating usage by hour...'
+                show_usage_by_hour(connection)
+            elif cli_params.show_stats:
+                print 'Calculating statistics...'
+                if cli_params.rolling or cli_params.percentiles:
+                    show_trend_stats(connection, cli_params.rolling, cli_params.subscriber,
+                                     cli_params.by_line, cli_params.since, cli_params.until)
+                else:
+                    show_connection_stats(connection, cli_params.subscriber, cli_params.by_line,
+                                          cli_params.since, cli_params.until)
+            elif cli_params.tariff_file:
+                print 'Simulating tariffs from \'{0}\'...'.format(cli_params.tariff_file)
+                show_tariff_simulation(connection, cli_params.tariff_file, cli_params.subscriber)
+            elif cli_params.export_dir:
+                print 'Exporting data to \'{0}\'...'.format(cli_params.export_dir)
+                export_data(connection, cli_params.export_dir)
+    except sqlite3.Error as error:
+        print 'ERROR: Could not query data base \'{0}\': {1}'.format(cli_params.data_base,
+                                                                    error)
     except SystemExit as signal:
         pass
     finally:
         # clean up
-        session.close()
-
-
-def add_invoice(invoice_file):
-
-    extraction_cmd = []
-    extractor = None
-    extracted_text = ''
-    error_msg = ''
-
-    billing_date = None
-
-    festnetz_calls = None
-    netzextern_calls = None
-    netzintern_calls = None
-    shortmessages = None
-    internet_connections = None
-
-    # extract text from .pdf
-    #   assemble command
-    extraction_cmd = EXTRACTION_COMMAND_TEMPLATE
-    extraction_cmd[extraction_cmd.index(INPUT_FILE_PLACEHOLDER)] = invoice_file
-    #   execute
-    extractor = subprocess.Popen(extraction_cmd,
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE)
-    extracted_text, error_msg = extractor.communicate()
-    #   handle errors
-    if (extractor.returncode != 0) or error_msg:
-        print "ERROR: %s" % str(error_msg)
-        raise SystemExit(1)
+        connection.close()
 
-    extractor = InvoiceParser(extracted_text)
 
+def serve_data_base(cli_params):
+    '''
+    answer queries over HTTP on plain, read-only connections to the data base
+    '''
+    import query_server
 
-    # process text extracted from pdf
     try:
-        billing_date = BillingDate(extractor.extract_rechnungsdatum())
-    except LookupError as error:
-        print 'ERROR: {0}'.format(error)
+        query_server.serve(cli_params.data_base, cli_params.address, cli_params.port)
+    except (sqlite3.Error, IOError) as error:
+        print 'ERROR: Could not serve data base \'{0}\': {1}'.format(cli_params.data_base,
+                                                                     error)
+    except SystemExit as signal:
+        pass
+
+
+def format_connection_type(type_, amount, net, gross):
+    return u"{0}\t{1} {2}\t| {3:.4f}\u20AC ({4:.4f}\u20AC)".format(type_,
+                                                                  amount,
+                                                                  CONNECTION_UNITS[type_],
+                                                                  to_euros(net),
+                                                                  to_euros(gross)).encode('utf-8')
+
+
+def print_lines(lines):
+    for subscriber, connection_types in lines:
+        print '   line {0}:'.format(format_subscriber(subscriber))
+        for connection_type in connection_types:
+            print '      {0}'.format(format_connection_type(*connection_type))
+
+
+def get_month(connection, month, subscriber=None, by_line=False):
+    if by_line:
+        months = query_months_by_line(connection, month, month)
+    else:
+        months = query_months(connection, month, month, subscriber)
+    if len(months) != 1:
+        print 'ERROR: Could not fetch data for month \'{0:%Y-%m}\' '\
+              'from data base: {1} billing dates registered{2}'.format(month, len(months),
+                                                                       '' if subscriber is None else
+                                                                       ' for line {0}'.format(format_subscriber(subscriber)))
         raise SystemExit(1)
 
-    # add one instance of each connection type to the current billing date
-    billing_date.connections.append(Calls(ConnectionType.FESTNETZ))
-    billing_date.connections.append(Calls(ConnectionType.NETZEXTERN))
-    billing_date.connections.append(Calls(ConnectionType.NETZINTERN))
-    billing_date.connections.append(TextMessages())
-    billing_date.connections.append(MobileWebConnections())
+    if by_line:
+        print_lines(months[0][1])
+        return
+    for connection_type in months[0][1]:
+        print '   {0}'.format(format_connection_type(*connection_type))
+
+
+def get_all_months(connection, first_month=None, last_month=None, subscriber=None, by_line=False):
+    if by_line:
+        for billing_date, lines in query_months_by_line(connection, first_month, last_month):
+            print "\n{0}:".format(billing_date)
+            print_lines(lines)
+        return
+
+    for billing_date, connection_types in query_months(connection, first_month, last_month,
+                                                       subscriber):
+        print "\n{0}:".format(billing_date)
+        for connection_type in connection_types:
+            print '   {0}'.format(format_connection_type(*connection_type))
+
+
+def list_registered_months(connection):
+    for (billing_date,) in connection.execute('SELECT date FROM billing_date ORDER BY date'):
+        print '   {0}'.format(billing_date)
+
+
+def list_registered_lines(connection):
+    for subscriber, num_months, first_date, last_date in connection.execute(
+            'SELECT subscriber, count(DISTINCT date_date), min(date_date), max(date_date) '\
+            'FROM connection_type GROUP BY subscriber ORDER BY subscriber'):
+        print '   {0:<16}: {1:>4} months ({2} through {3})'.format(format_subscriber(subscriber),
+                                                                   num_months, first_date,
+                                                                   last_date)
+
+
+def get_day(connection, day):
+    connections = connection.execute('SELECT timestamp, type_, destination, provider, '\
+                                     'duration, quantity, net FROM connection '\
+                                     'WHERE timestamp >= ? AND timestamp < ? '\
+                                     'ORDER BY timestamp',
+                                     (day.isoformat(), date.fromordinal(day.toordinal() + 1).isoformat()))
+    for timestamp, type_, destination, provider, duration, quantity, net in connections:
+        if type_ in (SMS, INET):
+            usage = '{0} {1}'.format(quantity, CONNECTION_UNITS[type_])
+        else:
+            usage = '{0}:{1:02d} min'.format(*divmod(duration, 60))
+        print u'   {0}  {1:<4}  {2:<16} {3:<10} {4:>10} | {5:.4f}\u20AC'.format(timestamp[11:19],
+                                                                             type_,
+                                                                             destination,
+                                                                             provider or '',
+                                                                             usage,
+                                                                             to_euros(net))
+
+
+def show_top_destinations(connection, limit):
+    destinations = connection.execute('SELECT destination, count(*) AS num_connections, '\
+                                      'sum(duration), sum(net) FROM connection '\
+                                      'WHERE type_ != ? GROUP BY destination '\
+                                      'ORDER BY num_connections DESC LIMIT ?',
+                                      (INET, limit))
+
+    print u' {0:^16}: {1:>11}   {2:>8} | {3:>8}\u20AC'.format('destination', 'connections', 'min', 'net')
+    print u'-'*52
+    for destination, count, duration, net in destinations:
+        print u'   {0:<14}: {1:>11}   {2:>8.1f} | {3:>8.2f}\u20AC'.format(destination, count,
+                                                                        (duration or 0) / 60.0,
+                                                                        to_euros(net))
+
+
+def show_usage_by_hour(connection):
+    usage = {}
+
+    for hour, type_, count, duration, quantity in connection.execute(
+            'SELECT strftime(\'%H\', timestamp) AS hour, type_, count(*), '\
+            'sum(duration), sum(quantity) FROM connection GROUP BY hour, type_'):
+        calls, minutes, short_messages, traffic = usage.setdefault(int(hour), [0, 0.0, 0, 0])
+        if type_ == SMS:
+            short_messages += quantity
+        elif type_ == INET:
+            traffic += quantity
+        else:
+            calls += count
+            minutes += duration / 60.0
+        usage[int(hour)] = [calls, minutes, short_messages, traffic]
+
+    print u' {0:^4}: {1:>6}   {2:>9}   {3:>6}   {4:>10}'.format('hour', 'calls', 'min', 'SMS', 'kB')
+    print u'-'*46
+    for hour in sorted(usage):
+        print u'   {0:02d}: {1[0]:>6}   {1[1]:>9.1f}   {1[2]:>6}   {1[3]:>10}'.format(hour, usage[hour])
+
+
+def format_percentiles(percentiles):
+    return u'({0:.1f}/{1:.1f}/{2:.1f})'.format(*percentiles)
+
+
+def print_connection_stats(stats, percentiles=None):
+    print u' {0:^20}: {1:^14}   {2:^5}   {3:^12}{4} | {5:>6}\u20AC ({6:>6}\u20AC)'.format('connection type',
+                                                                                          'avg',
+                                                                                          'stdev',
+                                                                                          '(min/max)',
+                                                                                          '' if percentiles is None else
+                                                                                          u'   {0:^24}'.format('(p50/p90/p99)'),
+                                                                                          'net',
+                                                                                          'gross')
+    print u'-'*(80 if percentiles is None else 107)
+    for type_, label, unit in STATISTICS_LABELS:
+        if type_ not in stats:
+            continue
+        count, mean, m2, min_, max_, net, gross = stats[type_]
+        print u'   {0:18}: {1:>10.2f} {2:<4}   {3:4}   {4:<12}{5} | {6:>6.2f}\u20AC ({7:>6.2f}\u20AC)'.format(label,
+                                                                                                          mean,
+                                                                                                          unit,
+                                                                                                          sqrt(m2 / count),
+                                                                                                          '({0}/{1})'.format(min_, max_),
+                                                                                                          '' if percentiles is None else
+                                                                                                          u'   {0:<24}'.format(format_percentiles(percentiles[type_])),
+                                                                                                          to_euros(net),
+                                                                                                          to_euros(gross))
+
+
+def print_rolling_stats(windows, window):
+    for type_, label, unit in STATISTICS_LABELS:
+        rows = [(first_date, last_date, stats[type_], percentiles[type_])
+                for first_date, last_date, stats, percentiles in windows if type_ in stats]
+        if not rows:
+            continue
+        print u'\n {0} ({1}) over {2} billing dates:'.format(label, unit, window)
+        print u' {0:^25}: {1:>10}   {2:>8}   {3:^24} | {4:>6}\u20AC ({5:>6}\u20AC)'.format('billing dates',
+                                                                                         'avg',
+                                                                                         'stdev',
+                                                                                         '(p50/p90/p99)',
+                                                                                         'net',
+                                                                                         'gross')
+        print u'-'*100
+        for first_date, last_date, (count, mean, m2, min_, max_, net, gross), percentiles in rows:
+            print u'   {0} - {1}: {2:>10.2f}   {3:>8.2f}   {4:<24} | {5:>6.2f}\u20AC ({6:>6.2f}\u20AC)'.format(first_date,
+                                                                                                         last_date,
+                                                                                                         mean,
+                                                                                                         sqrt(m2 / count),
+                                                                                                         format_percentiles(percentiles),
+                                                                                                         to_euros(net),
+                                                                                                         to_euros(gross))
+
+
+def show_connection_stats(connection, subscriber=None, by_line=False, first_month=None,
+                          last_month=None):
+    '''
+    display the statistics of the monthly usage of a line, over all lines
+    from the cache, or of the given line or of each line separately, of the
+    billing dates from the given first through the given last month only
+    '''
+    if not by_line and subscriber is None:
+        if first_month is None and last_month is None:
+            print_connection_stats(fetch_connection_stats(connection))
+            return
+        stats = query_connection_stats(connection, first_month, last_month)
+        lines = {None: stats} if stats else {}
+    else:
+        lines = query_line_stats(connection, subscriber, first_month, last_month)
+
+    if not lines:
+        print 'ERROR: No billing dates registered{0}'.format(format_selection(subscriber, first_month,
+                                                                               last_month))
+        raise SystemExit(1)
+    for line in sorted(lines):
+        if by_line:
+            print '\nline {0}:'.format(format_subscriber(line))
+        print_connection_stats(lines[line])
 
-    # parse data for each connection type
-    for connection_type in billing_date.connections:
-        try:
-            extractor.extract_connections(connection_type)
-        except UserWarning as warning:
-            print 'WARNING: {0}'.format(warning)
 
-    # write results to data base
+def show_trend_stats(connection, window=None, subscriber=None, by_line=False, first_month=None,
+                     last_month=None):
+    '''
+    display the statistics of the monthly usage along with its percentiles
+    over each window of the given number of consecutive billing dates, or
+    over all billing dates from the given first through the given last month
+    '''
     try:
-        session.commit()
-    except IntegrityError as error:
-        print "ERROR: Could not add new connections to data base: {0}".format(error)
-        session.rollback()
+        import trend_statistics
+    except ImportError as error:
+        print 'ERROR: Could not calculate percentiles: {0}'.format(error)
         raise SystemExit(1)
 
-    # feed added data back to user
-    print 'The following data has been registered for billing date {0}:'.format(billing_date.date)
-    for connection_type in billing_date.connections:
-        print connection_type
+    lines = trend_statistics.compute_stats(connection, window, subscriber, first_month, last_month,
+                                           by_line)
+    if not lines:
+        print 'ERROR: No billing dates registered{0}'.format(format_selection(subscriber, first_month,
+                                                                               last_month))
+        raise SystemExit(1)
+    if not any(lines.values()):
+        print 'ERROR: Fewer than {0} billing dates registered{1}'.format(window,
+                                                                         format_selection(subscriber,
+                                                                                          first_month,
+                                                                                          last_month))
+        raise SystemExit(1)
 
+    for line in sorted(lines):
+        if by_line:
+            print '\nline {0}:'.format(format_subscriber(line))
+        if window:
+            print_rolling_stats(lines[line], window)
+        else:
+            first_date, last_date, stats, percentiles = lines[line][0]
+            print_connection_stats(stats, percentiles)
 
 
-def get_month(month):
+def show_tariff_simulation(connection, tariff_file, subscriber=None):
     try:
-        result = BillingDate.query.filter(BillingDate.date.like('{0:%Y-%m-__}'.format(month))).one()
-        for connection_type in result.connections:
-            print '   {0}'.format(connection_type)
-    except (NoResultFound, MultipleResultsFound) as error:
-        print 'ERROR: Could not fetch data for month \'{0:%Y-%m}\' '\
-              'from data base: {1}'.format(month, error)
+        import tariff_simulator
+    except ImportError as error:
+        print 'ERROR: Could not simulate tariffs: {0}'.format(error)
+        raise SystemExit(1)
+
+    try:
+        plans = tariff_simulator.load_plans(tariff_file)
+    except (IOError, ValueError) as error:
+        print 'ERROR: Could not load plans from \'{0}\': {1}'.format(tariff_file, error)
+        raise SystemExit(1)
+    usage = tariff_simulator.load_usage(connection, subscriber)
+    if not usage.months:
+        print 'ERROR: No billing dates registered{0}'.format(format_selection(subscriber))
+        raise SystemExit(1)
+    costs = tariff_simulator.simulate(usage, plans)
+    totals = costs.sum(axis=1)
+    ranking = totals.argsort(kind='mergesort')
+
+    if subscriber is not None:
+        print 'Costs of line {0}:\n'.format(format_subscriber(subscriber))
+    elif len(usage.lines) > 1:
+        print 'Costs of {0} lines, each on a plan of its own:\n'.format(len(usage.lines))
+    print u' {0:^24}: {1:>10}   {2:>9}   {3:>19}'.format('plan', 'total', 'per month', '(min/max)')
+    print u'-'*72
+    for index in ranking:
+        print u'   {0:22}: {1:>9.2f}\u20AC   {2:>8.2f}\u20AC   {3:>19}'.format(plans.names[index][:22],
+                                                                          totals[index],
+                                                                          totals[index] / len(usage.months),
+                                                                          '({0:.2f}/{1:.2f})'.format(costs[index].min(),
+                                                                                                     costs[index].max()))
+
+    print u'\n   {0:^10}: {1}'.format('month', ' '.join(u'{0:>12}'.format(plans.names[index][:12])
+                                                        for index in ranking[:TARIFF_COLUMNS]))
+    print u'-'*(14 + 13 * len(ranking[:TARIFF_COLUMNS]))
+    for month, billing_date in enumerate(usage.months):
+        print u'   {0}: {1}'.format(billing_date, ' '.join(u'{0:>11.2f}\u20AC'.format(costs[index, month])
+                                                        for index in ranking[:TARIFF_COLUMNS]))
+
+
+def export_data(connection, export_dir):
+    try:
+        import columnar_export
+    except ImportError as error:
+        print 'ERROR: Could not export data: {0}'.format(error)
         raise SystemExit(1)
 
+    try:
+        num_dates, num_connections = columnar_export.export(connection, export_dir)
+    except (IOError, OSError, ValueError) as error:
+        print 'ERROR: Could not export data to \'{0}\': {1}'.format(export_dir, error)
+        raise SystemExit(1)
 
-def get_all_months():
-    months = BillingDate.query.order_by(asc(BillingDate.date)).all()
-    for month in months:
-        print "\n{0}:".format(month)
-        for connection_type in month.connections:
-            print '   {0}'.format(connection_type)
-
-def list_registered_months():
-    for month in BillingDate.query.order_by(asc(BillingDate.date)).all():
-        print '   {0}'.format(month)
-
-def show_connection_stats():
-    # fetch avg, min and max values from data base
-    net_external = session.query(func.avg(ConnectionType.amount),
-                                 func.min(ConnectionType.amount),
-                                 func.max(ConnectionType.amount),
-                                 func.avg(ConnectionType.net),
-                                 func.avg(ConnectionType.gross)
-                                ).filter(ConnectionType.type_==ConnectionType.NETZEXTERN).one()
-    net_internal = session.query(func.avg(ConnectionType.amount),
-                                 func.min(ConnectionType.amount),
-                                 func.max(ConnectionType.amount),
-                                 func.avg(ConnectionType.net),
-                                 func.avg(ConnectionType.gross)
-                                ).filter(ConnectionType.type_==ConnectionType.NETZINTERN).one()
-    land_line = session.query(func.avg(ConnectionType.amount),
-                              func.min(ConnectionType.amount),
-                              func.max(ConnectionType.amount),
-                              func.avg(ConnectionType.net),
-                              func.avg(ConnectionType.gross)
-                             ).filter(ConnectionType.type_==ConnectionType.FESTNETZ).one()
-    short_messages = session.query(func.avg(ConnectionType.amount),
-                                   func.min(ConnectionType.amount),
-                                   func.max(ConnectionType.amount),
-                                   func.avg(ConnectionType.net),
-                                   func.avg(ConnectionType.gross)
-                                  ).filter(ConnectionType.type_==ConnectionType.SMS).one()
-    web_connections = session.query(func.avg(MobileWebConnections.amount),
-                                    func.min(MobileWebConnections.amount),
-                                    func.max(MobileWebConnections.amount),
-                                    func.avg(MobileWebConnections.net),
-                                    func.avg(MobileWebConnections.gross)
-                                   ).filter(ConnectionType.type_==ConnectionType.INET).one()
-
-    # calculate standard deviations that sqlite cannot provice
-    net_external_stdev = std(session.query(ConnectionType.amount).filter(ConnectionType.type_==ConnectionType.NETZEXTERN).all())
-    net_internal_stdev = std(session.query(ConnectionType.amount).filter(ConnectionType.type_==ConnectionType.NETZINTERN).all())
-    land_line_stdev = std(session.query(ConnectionType.amount).filter(ConnectionType.type_==ConnectionType.FESTNETZ).all())
-    short_messages_stdev = std(session.query(ConnectionType.amount).filter(ConnectionType.type_==ConnectionType.SMS).all())
-    web_connections_stdev = std(session.query(ConnectionType.amount).filter(ConnectionType.type_==ConnectionType.INET).all())
-
-
-    #len_min = max(len(str(net_external[1])), len(str(net_internal[1])),
-    #              len(str(land_line[1])), len(str(short_messages[1])),
-    #              len(str(web_connections[1])))
-
-    print u' {0:^20}: {1:^14}   {2:^5}   {3:^12} | {4:>6}\u20AC ({5:>6}\u20AC)'.format('connection type',
-                                                                                       'avg',
-                                                                                       'stdev',
-                                                                                       '(min/max)',
-                                                                                       'net',
-                                                                                       'gross')
-    print u'-'*80
-    print u'   {0:18}: {1[0]:>10.2f} min    {2:4}   {3:<12} | {1[3]:>6.2f}\u20AC ({1[4]:>6.2f}\u20AC)'.format('net external calls',
-                                                                                                              net_external,
-                                                                                                              net_external_stdev,
-                                                                                                              '({0[1]}/{0[2]})'.format(net_external))
-    print u'   {0:18}: {1[0]:>10.2f} min    {2:4}   {3:<12} | {1[3]:>6.2f}\u20AC ({1[4]:>6.2f}\u20AC)'.format('net internal calls',
-                                                                                                              net_internal,
-                                                                                                              net_internal_stdev,
-                                                                                                              '({0[1]}/{0[2]})'.format(net_internal))
-    print u'   {0:18}: {1[0]:>10.2f} min    {2:4}   {3:<12} | {1[3]:>6.2f}\u20AC ({1[4]:>6.2f}\u20AC)'.format('land line calls',
-                                                                                                              land_line,
-                                                                                                              land_line_stdev,
-                                                                                                              '({0[1]}/{0[2]})'.format(land_line))
-    print u'   {0:18}: {1[0]:>10.2f} SMS    {2:4}   {3:<12} | {1[3]:>6.2f}\u20AC ({1[4]:>6.2f}\u20AC)'.format('short messages',
-                                                                                                              short_messages,
-                                                                                                              short_messages_stdev,
-                                                                                                              '({0[1]}/{0[2]})'.format(short_messages))
-    print u'   {0:18}: {1[0]:>10.2f} kB     {2:4}   {3:<12} | {1[3]:>6.2f}\u20AC ({1[4]:>6.2f}\u20AC)'.format('mobile traffic',
-                                                                                                              web_connections,
-                                                                                                              web_connections_stdev,
-                                                                                                              '({0[1]}/{0[2]})'.format(web_connections))
-
-def connect_to_db(data_base):
-
-    metadata.bind = 'sqlite:///{0}'.format(data_base)
-
-    #DEBUG
-    #metadata.bind.echo = True
-
-    # setup data base tables and object mappers
-    setup_all(True)
+    print 'Exported {0} new billing dates with {1} connections.'.format(num_dates,
+                                                                     num_connections)
 
 
 #
@@ -0,0 +1,187 @@
+'''
+Export of the registered billing data as columns of NumPy `.npy` files.
+
+The export directory holds a directory per table with a file per column, all
+of the same number of rows:
+
+    months/       billing_date, subscriber, type, amount, net, gross
+    connections/  billing_date, subscriber, type, timestamp, destination,
+                  provider, duration, quantity, net
+
+Every file can be memory-mapped with `numpy.load(path, mmap_mode='r')`, or all
+of them at once with `load_export`. Money is stored as in the data base, in
+integer ten-thousandths of a euro, missing durations and quantities are
+stored as `MISSING`. Exporting again only appends the lines of billing dates
+added in the meantime, the rows of a table are in order of export, not by
+date. The number of complete rows of each table is kept in a manifest, so an
+interrupted export is rolled back by the next one.
+'''
+
+import json
+import os
+import struct
+from itertools import groupby
+
+import numpy as np
+
+
+MANIFEST_FILE = 'manifest.json'
+# version of the export layout
+#   2: money in integer ten-thousandths of a euro rather than float euros
+#   3: phone line of the months and connections
+MANIFEST_VERSION = 3
+COLUMN_FILE_SUFFIX = '.npy'
+# fixed size of the headers, so the shape can be updated in place on appending
+HEADER_SIZE = 128
+MISSING = -1
+MONTH_COLUMNS = [('billing_date', 'datetime64[D]'),
+                 ('subscriber', 'S32'),
+                 ('type', 'S4'),
+                 ('amount', '<i8'),
+                 ('net', '<i8'),
+                 ('gross', '<i8')]
+CONNECTION_COLUMNS = [('billing_date', 'datetime64[D]'),
+                      ('subscriber', 'S32'),
+                      ('type', 'S4'),
+                      ('timestamp', 'datetime64[s]'),
+                      ('destination', 'S32'),
+                      ('provider', 'S32'),
+                      ('duration', '<i8'),
+                      ('quantity', '<i8'),
+                      ('net', '<i8')]
+TABLES = [('months', MONTH_COLUMNS), ('connections', CONNECTION_COLUMNS)]
+
+
+def _write_header(column_file, dtype, num_rows):
+    header = '{{\'descr\': {0!r}, \'fortran_order\': False, '\
+             '\'shape\': ({1},), }}'.format(np.lib.format.dtype_to_descr(dtype), num_rows)
+    column_file.seek(0)
+    column_file.write(np.lib.format.magic(1, 0))
+    column_file.write(struct.pack('<H', HEADER_SIZE - 10))
+    column_file.write(header.ljust(HEADER_SIZE - 11) + '\n')
+
+
+def append_column(path, dtype, num_rows, values):
+    '''
+    append the given values to the column file of the given number of complete
+    rows, dropping any incomplete rows behind them
+    '''
+    dtype = np.dtype(dtype)
+    values = np.asarray(values, dtype=dtype)
+
+    with open(path, 'r+b' if os.path.exists(path) else 'w+b') as column_file:
+        if num_rows:
+            np.lib.format.read_magic(column_file)
+            shape, fortran_order, stored_dtype = np.lib.format.read_array_header_1_0(column_file)
+            if stored_dtype != dtype or column_file.tell() != HEADER_SIZE:
+                raise ValueError('Incompatible column \'{0}\''.format(path))
+        column_file.truncate(HEADER_SIZE + num_rows * dtype.itemsize)
+        column_file.seek(0, os.SEEK_END)
+        if column_file.tell() < HEADER_SIZE:
+            _write_header(column_file, dtype, 0)
+        values.tofile(column_file)
+        _write_header(column_file, dtype, num_rows + len(values))
+
+
+def read_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST_FILE)) as manifest_file:
+            manifest = json.load(manifest_file)
+    except IOError:
+        return {'version': MANIFEST_VERSION, 'rows': dict.fromkeys(dict(TABLES), 0)}
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError('Unsupported export version {0}'.format(manifest.get('version')))
+    return manifest
+
+
+def write_manifest(directory, manifest):
+    '''
+    replace the manifest at once, committing the appended rows
+    '''
+    temp_path = os.path.join(directory, MANIFEST_FILE + '.tmp')
+    with open(temp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.rename(temp_path, os.path.join(directory, MANIFEST_FILE))
+
+
+def load_export(directory, mmap_mode='r'):
+    '''
+    memory-map all complete columns of the export in the given directory,
+    return them as a dict of tables, each a dict of columns
+    '''
+    manifest = read_manifest(directory)
+    tables = {}
+    for table, columns in TABLES:
+        tables[table] = {}
+        for column, dtype in columns:
+            path = os.path.join(directory, table, column + COLUMN_FILE_SUFFIX)
+            if manifest['rows'][table]:
+                tables[table][column] = np.load(path, mmap_mode=mmap_mode)[:manifest['rows'][table]]
+            else:
+                tables[table][column] = np.empty(0, dtype=dtype)
+    return tables
+
+
+def _fetch_columns(rows, columns):
+    '''
+    turn the given rows into one array per column
+    '''
+    return [np.array(values, dtype=dtype) for values, (column, dtype)
+            in zip(zip(*rows) or [[]] * len(columns), columns)]
+
+
+def export(connection, directory):
+    '''
+    append the lines of billing dates that have not been exported to the given
+    directory yet, return the number of billing dates and connections added
+    '''
+    manifest = read_manifest(directory)
+    exported = set()
+    new_lines = []
+    num_connections = 0
+
+    for table, columns in TABLES:
+        if not os.path.isdir(os.path.join(directory, table)):
+            os.makedirs(os.path.join(directory, table))
+
+    if manifest['rows']['months']:
+        exported = set(zip((str(billing_date) for billing_date in
+                            np.load(os.path.join(directory, 'months', 'billing_date' + COLUMN_FILE_SUFFIX),
+                                    mmap_mode='r')[:manifest['rows']['months']]),
+                           np.load(os.path.join(directory, 'months', 'subscriber' + COLUMN_FILE_SUFFIX),
+                                   mmap_mode='r')[:manifest['rows']['months']]))
+    new_lines = [(billing_date, subscriber) for billing_date, subscriber in
+                 connection.execute('SELECT DISTINCT date_date, subscriber FROM connection_type '\
+                                    'ORDER BY date_date, subscriber')
+                 if (billing_date, subscriber.encode('utf-8')) not in exported]
+
+    for billing_date, lines in groupby(new_lines, lambda line: line[0]):
+        subscribers = set(subscriber for billing_date_, subscriber in lines)
+        month_rows = [(date_, subscriber.encode('utf-8'), type_, amount, net, gross)
+                      for date_, subscriber, type_, amount, net, gross
+                      in connection.execute('SELECT date_date, subscriber, type_, amount, net, gross '\
+                                            'FROM connection_type WHERE date_date = ? '\
+                                            'ORDER BY rowid', (billing_date,))
+                      if subscriber in subscribers]
+        connection_rows = [(date_, subscriber.encode('utf-8'), type_, timestamp,
+                            (destination or u'').encode('utf-8'), (provider or u'').encode('utf-8'),
+                            MISSING if duration is None else duration,
+                            MISSING if quantity is None else quantity, net)
+                           for date_, subscriber, type_, timestamp, destination, provider, duration, quantity, net
+                           in connection.execute('SELECT billing_date, subscriber, type_, timestamp, '\
+                                                 'destination, provider, duration, quantity, net '\
+                                                 'FROM connection WHERE billing_date = ? '\
+                                                 'ORDER BY timestamp', (billing_date,))
+                           if subscriber in subscribers]
+
+        # the appended rows only count once the manifest has been updated
+        for table, columns, rows in [('connections', CONNECTION_COLUMNS, connection_rows),
+                                     ('months', MONTH_COLUMNS, month_rows)]:
+            for (column, dtype), values in zip(columns, _fetch_columns(rows, columns)):
+                append_column(os.path.join(directory, table, column + COLUMN_FILE_SUFFIX),
+                              dtype, manifest['rows'][table], values)
+            manifest['rows'][table] += len(rows)
+        write_manifest(directory, manifest)
+        num_connections += len(connection_rows)
+
+    return len(set(billing_date for billing_date, subscriber in new_lines)), num_connections
@@ -0,0 +1,151 @@
+'''
+Instrumentation of the stages of adding invoices and answering queries.
+
+Every stage records its wall time, its CPU time and the CPU time of the child
+processes it waited for (such as `pdftotext`). Counters keep track of matched
+lines or issued SQL statements. The report closes with the peak resident set
+size of the process and of its children.
+'''
+
+import os
+import resource
+import time
+from contextlib import contextmanager
+
+
+class Instrumentation:
+    '''
+    Collect the timings of named stages and counters, as long as it is enabled
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        # stage name -> [wall, cpu, child_cpu, calls], in order of appearance
+        self.stages = {}
+        self.order = []
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name):
+        '''
+        time the enclosed block as the given stage
+        '''
+        if not self.enabled:
+            yield
+            return
+
+        wall, times = time.time(), os.times()
+        try:
+            yield
+        finally:
+            self._add_times(name, wall, times)
+
+    def timed_iter(self, name, iterable):
+        '''
+        time the retrieval of every item of the given iterable as the given
+        stage, e.g. to tell the time spent waiting for a producer
+        '''
+        if not self.enabled:
+            return iterable
+        return self._timed_iter(name, iter(iterable))
+
+    def _timed_iter(self, name, iterator):
+        while True:
+            wall, times = time.time(), os.times()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                # one call per exhausted iterable
+                self.add(name, 0.0)
+                return
+            finally:
+                self._add_times(name, wall, times, calls=0)
+            yield item
+
+    def _add_times(self, name, wall, times, calls=1):
+        now = os.times()
+        self.add(name,
+                 time.time() - wall,
+                 (now[0] + now[1]) - (times[0] + times[1]),
+                 (now[2] + now[3]) - (times[2] + times[3]),
+                 calls)
+
+    def add(self, name, wall, cpu=0.0, child_cpu=0.0, calls=1):
+        if name not in self.stages:
+            self.stages[name] = [0.0, 0.0, 0.0, 0]
+            self.order.append(name)
+        stage = self.stages[name]
+        stage[0] += wall
+        stage[1] += cpu
+        stage[2] += child_cpu
+        stage[3] += calls
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, other):
+        '''
+        add the stages and counters reported by another process, e.g. a worker
+        '''
+        for stage in other['stages']:
+            self.add(stage['name'], stage['wall'], stage['cpu'], stage['child_cpu'],
+                     stage['calls'])
+        for name, value in other['counters'].items():
+            self.count(name, value)
+
+    def as_dict(self):
+        return {'stages': [{'name': name,
+                            'wall': self.stages[name][0],
+                            'cpu': self.stages[name][1],
+                            'child_cpu': self.stages[name][2],
+                            'calls': self.stages[name][3]} for name in self.order],
+                'counters': dict(self.counters),
+                # kilobytes on Linux
+                'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                'peak_child_rss': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss}
+
+    def report(self):
+        '''
+        format the collected timings for humans
+        '''
+        timings = self.as_dict()
+        lines = ['{0:<16} | {1:>9} | {2:>9} | {3:>9} | {4:>6}'.format('stage', 'wall', 'cpu',
+                                                                     'child cpu', 'calls'),
+                 '-' * 61]
+        for stage in timings['stages']:
+            lines.append('{0:<16} | {1:>8.3f}s | {2:>8.3f}s | {3:>8.3f}s | {4:>6}'.format(stage['name'],
+                                                                                  stage['wall'],
+                                                                                  stage['cpu'],
+                                                                                  stage['child_cpu'],
+                                                                                  stage['calls']))
+        lines.append('-' * 61)
+        for name, value in sorted(timings['counters'].items()):
+            lines.append('{0:<16} : {1}'.format(name.replace('_', ' '), value))
+        lines.append('{0:<16} : {1} kB'.format('peak rss', timings['peak_rss']))
+        lines.append('{0:<16} : {1} kB'.format('peak child rss', timings['peak_child_rss']))
+        return '\n'.join(lines)
+
+
+class CountingConnection:
+    '''
+    Wrap a DB-API connection to count the statements executed on it
+    '''
+
+    def __init__(self, connection, instrumentation):
+        self.connection = connection
+        self.instrumentation = instrumentation
+
+    def execute(self, *args):
+        self.instrumentation.count('sql_statements')
+        return self.connection.execute(*args)
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+# shared by all modules of the process
+instrumentation = Instrumentation()
@@ -0,0 +1,31 @@
+'''
+Constants of the invoices and of the data base layout shared by the modules
+writing and querying the data base.
+
+This module only holds plain values, so that importing it neither loads the
+ORM nor NumPy.
+'''
+
+
+VAT_PERCENT = 19
+VAT_FACTOR = 1 + VAT_PERCENT / 100.0
+# money is stored in integer ten-thousandths of a euro, the precision of the
+# prices on the invoices
+MONEY_SCALE = 10000
+# line of the connections of invoices that do not name it
+DEFAULT_SUBSCRIBER = ''
+# characters dropped from the phone numbers of lines
+SUBSCRIBER_SEPARATORS = ' /-'
+# version of the data base layout in `PRAGMA user_version`
+#   1: money stored in units of `MONEY_SCALE` rather than as float euros
+#   2: connection types and connections of multiple lines per billing date
+#   3: billing date of processed files only kept by the digest of the invoice
+SCHEMA_VERSION = 3
+
+# connection types as stored in the data base
+FESTNETZ = 'NA'
+NETZEXTERN = 'NX'
+NETZINTERN = 'PI'
+SMS = 'SMS'
+INET = 'GPRS'
+CALL_TYPES = [FESTNETZ, NETZEXTERN, NETZINTERN]
@@ -0,0 +1,1349 @@
+'''
+ORM model of the invoice data base and everything that writes to it.
+
+Loading elixir and SQLAlchemy dominates the start-up time, so this module is
+only imported for adding invoices and maintaining the data base, queries are
+answered by `invoice_queries` on its own.
+'''
+
+import os
+import glob
+import subprocess
+import multiprocessing
+import tempfile
+import hashlib
+import gzip
+import re
+import sqlite3
+import time
+from itertools import groupby
+from datetime import datetime, date
+from math import sqrt
+from elixir import *
+from sqlalchemy import Table, Column, ForeignKey, Index, func, event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateTable, CreateIndex
+
+from instrumentation import instrumentation
+from invoice_constants import VAT_PERCENT, VAT_FACTOR, MONEY_SCALE, DEFAULT_SUBSCRIBER, \
+                              SUBSCRIBER_SEPARATORS, SCHEMA_VERSION, FESTNETZ, NETZEXTERN, \
+                              NETZINTERN, SMS, INET
+
+
+INPUT_FILE_PLACEHOLDER = '%%INPUT_FILE%%'
+EXTRACTION_COMMAND_TEMPLATE = ['pdftotext', '-layout', INPUT_FILE_PLACEHOLDER, '-']
+DEFAULT_EXTRACTOR = 'pdftotext'
+# vertical distance in points below which text is considered to be on one line
+LINE_TOLERANCE = 2
+INVOICE_FILE_PATTERN = '*.pdf'
+INVOICES_PER_TRANSACTION = 100
+CONNECTIONS_PER_INSERT = 10000
+EXTRACTION_CACHE_SUFFIX = '.txt.gz'
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class BillingDate(Entity):
+    using_options(tablename='billing_date', inheritance='multi')
+
+    date = Field(Date, primary_key=True)
+    connections = OneToMany('ConnectionType')
+
+    def __init__(self, billing_date):
+        self.date = billing_date
+        self.calls = ()
+
+    def __str__(self):
+        return str(self.date)
+
+
+class InvoiceFile(Entity):
+    '''
+    the content digest of an added invoice, to recognize it once it is added
+    again
+    '''
+    using_options(tablename='invoice_file')
+
+    digest = Field(String(64), primary_key=True)
+    billing_date = ManyToOne('BillingDate')
+
+    def __init__(self, digest, billing_date):
+        self.digest = digest
+        self.billing_date = billing_date
+
+
+class ProcessedFile(Entity):
+    '''
+    manifest entry of an ingested invoice file, the file is not even hashed
+    again as long as its modification time and size are unchanged; its billing
+    date is that of its digest in `InvoiceFile`
+    '''
+    using_options(tablename='processed_file')
+
+    path = Field(String(1024), primary_key=True)
+    mtime = Field(Float)
+    size = Field(Integer)
+    digest = Field(String(64), index=True)
+
+    def __init__(self, path):
+        self.path = path
+
+
+class ConnectionType(Entity):
+    FESTNETZ = FESTNETZ
+    NETZEXTERN = NETZEXTERN
+    NETZINTERN = NETZINTERN
+    SMS = SMS
+    INET = INET
+
+    FEES = { FESTNETZ: {'net': 0.00, 'gross': 0.00},
+             NETZEXTERN: {'net': 0.00, 'gross': 0.00},
+             NETZINTERN: {'net': 0.00, 'gross': 0.00},
+             SMS: {'net': 0.00, 'gross': 0.00},
+             INET: {'net': 0.00, 'gross': 0.00} }
+
+    # set gross prices
+    FEES[FESTNETZ]['gross'] = 0.09
+    FEES[NETZEXTERN]['gross'] = 0.09
+    FEES[NETZINTERN]['gross'] = 0.09
+    FEES[SMS]['gross'] = 0.09
+    FEES[INET]['gross'] = 0.49
+
+    # calculate net fees from given gross values
+    FEES[FESTNETZ]['net'] = FEES[FESTNETZ]['gross'] / VAT_FACTOR
+    FEES[NETZEXTERN]['net'] = FEES[NETZEXTERN]['gross'] / VAT_FACTOR
+    FEES[NETZINTERN]['net'] = FEES[NETZINTERN]['gross'] / VAT_FACTOR
+    FEES[SMS]['net'] = FEES[SMS]['gross'] / VAT_FACTOR
+    FEES[INET]['net'] = FEES[INET]['gross'] / VAT_FACTOR
+
+    # gross fees in units of MONEY_SCALE
+    GROSS_FEES = dict((type_, int(round(fees['gross'] * MONEY_SCALE)))
+                      for type_, fees in FEES.items())
+
+
+    using_options(tablename='connection_type', inheritance='multi')
+    using_table_options(Index('ix_connection_type_subscriber_date', 'subscriber', 'date_date'))
+
+    type_ = Field(String(4), primary_key=True)
+    # phone number of the line
+    subscriber = Field(String(32), primary_key=True)
+    amount = Field(Integer)
+    # in units of MONEY_SCALE
+    net = Field(Integer)
+    gross = Field(Integer)
+    date = ManyToOne('BillingDate', primary_key=True)
+
+
+    # pattern for the remainder of a connection line following its date, time
+    # and type, as dispatched by the InvoiceParser
+    PARSE_PATTERN = None
+
+    def __init__(self, connection_type, subscriber=DEFAULT_SUBSCRIBER):
+        self.type_ = connection_type
+        self.subscriber = subscriber
+        self.amount = 0
+        self.net = 0
+        self.gross = 0
+        # individual connections as the date, time and groups of the parse
+        # pattern they were matched with, the price being the last group; they
+        # are only converted in bulk when summed up and written to the
+        # connection table
+        self.details = []
+        # number of connections summed up so far
+        self.totalled = 0
+
+    def get_parse_pattern(self):
+        return self.PARSE_PATTERN
+
+    def update_totals(self):
+        '''
+        add the connections added since the last update to the totals, VAT is
+        applied once to the net total
+        '''
+        details = self.details[self.totalled:]
+        # prices have four decimal places (e.g. '0,0756'), so dropping the
+        # comma yields them in units of MONEY_SCALE
+        prices = [int(detail[-1].replace(',', '')) for detail in details]
+
+        self.net += sum(prices)
+        self.gross = apply_vat(self.net)
+        self.amount += self._count_amount(prices, details)
+        self.totalled = len(self.details)
+
+    def _count_amount(self, prices, details):
+        # each connection is charged a whole number of gross fees
+        gross_fee = ConnectionType.GROSS_FEES[self.type_] * 100
+        return sum(divide_rounded(net_price * (100 + VAT_PERCENT), gross_fee)
+                   for net_price in prices)
+
+    def get_connections(self):
+        '''
+        convert the individual connections into rows of timestamp, destination,
+        provider, duration in seconds, quantity and net price
+        '''
+        return [(parse_timestamp(detail[0], detail[1]),) + self._convert_fields(*detail[2:])
+                for detail in self.details]
+
+
+class Calls(ConnectionType):
+
+    using_options(tablename='calls', inheritance='multi')
+
+    PARSE_PATTERN = re.compile(' +(?P<destination>%(destNumber)s) +(?P<provider>%(destProvider)s) +(?P<duration>%(duration)s) +(?P<price>%(price)s)' % {'destNumber': '\d+',
+                               'destProvider': '\S+',
+                               'duration': '\d+:\d{2}',
+                               'price': '\d+,\d{4}'})
+
+    def __init__(self, call_type, subscriber=DEFAULT_SUBSCRIBER):
+        super(Calls, self).__init__(call_type, subscriber)
+
+    def _convert_fields(self, destination, provider, duration, price):
+        return destination, provider, parse_duration(duration), None, int(price.replace(',', ''))
+
+
+    def __str__(self):
+        return u"{0}\t{1} min\t| {2}\u20AC ({3}\u20AC)".format(self.type_,
+                                                              self.amount,
+                                                              format_money(self.net),
+                                                              format_money(self.gross)).encode('utf-8')
+
+class TextMessages(ConnectionType):
+
+    using_options(tablename='text_messages', inheritance='multi')
+
+    PARSE_PATTERN = re.compile(' +(?P<destination>%(destNumber)s) +(?P<provider>%(destProvider)s) +(?P<quantity>%(quantity)s) +(?P<price>%(price)s)' % {'destNumber': '\d+',
+                               'destProvider': '\S+',
+                               'quantity': '\d+',
+                               'price': '\d+,\d{4}'})
+
+    def __init__(self, subscriber=DEFAULT_SUBSCRIBER):
+        super(TextMessages, self).__init__(ConnectionType.SMS, subscriber)
+
+    def _convert_fields(self, destination, provider, quantity, price):
+        return destination, provider, None, int(quantity), int(price.replace(',', ''))
+
+
+    def __str__(self):
+        return u"{0}\t{1} SMS\t| {2}\u20AC ({3}\u20AC)".format(self.type_,
+                                                              self.amount,
+                                                              format_money(self.net),
+                                                              format_money(self.gross)).encode('utf-8')
+
+
+class MobileWebConnections(ConnectionType):
+
+    using_options(tablename='mobile_web_connections', inheritance='multi')
+
+    # klarmobil charges for 100KB chunks
+    INET_CHUNK_SIZE = 100
+
+    PARSE_PATTERN = re.compile(' +(?P<destination>%(gateway)s) +- +(?P<duration>%(duration)s)/ +(?P<quantity>%(quantity)s) +(?P<price>%(price)s)' % {'gateway': 'internet.online',
+                               'duration': '\d+:\d{2}',
+                               'quantity': '\d+',
+                               'price': '\d+,\d{4}'})
+
+    def __init__(self, subscriber=DEFAULT_SUBSCRIBER):
+        super(MobileWebConnections, self).__init__(ConnectionType.INET, subscriber)
+
+    def _convert_fields(self, destination, duration, quantity, price):
+        return destination, None, parse_duration(duration), int(quantity), int(price.replace(',', ''))
+
+    def __str__(self):
+        return u"{0}\t{1} kB\t| {2}\u20AC ({3}\u20AC)".format(self.type_,
+                                                              self.amount,
+                                                              format_money(self.net),
+                                                              format_money(self.gross)).encode('utf-8')
+
+
+
+    def _count_amount(self, prices, details):
+        return sum(amount + (MobileWebConnections.INET_CHUNK_SIZE - (amount % MobileWebConnections.INET_CHUNK_SIZE))
+                   for amount in (int(detail[-2]) for detail in details))
+
+
+# individual connections are only ever written in bulk, so they are kept in a
+# plain table rather than being mapped to an entity
+connection_table = Table('connection', metadata,
+                         Column('billing_date', Date, ForeignKey('billing_date.date'), nullable=False),
+                         Column('subscriber', String(32), nullable=False),
+                         Column('type_', String(4), nullable=False),
+                         Column('timestamp', DateTime, nullable=False),
+                         Column('destination', String(32)),
+                         Column('provider', String(32)),
+                         Column('duration', Integer),
+                         Column('quantity', Integer),
+                         Column('net', Integer),
+                         Index('ix_connection_billing_date_type', 'billing_date', 'type_'),
+                         Index('ix_connection_subscriber_billing_date', 'subscriber', 'billing_date'),
+                         Index('ix_connection_timestamp', 'timestamp'))
+
+
+class ConnectionStatistics(Entity):
+    '''
+    running statistics over the amounts of a connection type per line and
+    billing date, updated with every added one (Welford's algorithm)
+    '''
+    using_options(tablename='connection_statistics')
+
+    type_ = Field(String(4), primary_key=True)
+    count = Field(Integer)
+    mean = Field(Float)
+    m2 = Field(Float)
+    min_ = Field(Integer)
+    max_ = Field(Integer)
+    # mean amounts of money in units of MONEY_SCALE
+    net = Field(Float)
+    gross = Field(Float)
+
+
+    def __init__(self, connection_type):
+        self.type_ = connection_type
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min_ = None
+        self.max_ = None
+        self.net = 0.0
+        self.gross = 0.0
+
+    def add(self, amount, net, gross):
+        self.count += 1
+        delta = amount - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (amount - self.mean)
+        self.min_ = amount if self.min_ is None else min(self.min_, amount)
+        self.max_ = amount if self.max_ is None else max(self.max_, amount)
+        self.net += (net - self.net) / self.count
+        self.gross += (gross - self.gross) / self.count
+
+    def get_stdev(self):
+        return sqrt(self.m2 / self.count) if self.count else 0.0
+
+
+def divide_rounded(numerator, denominator):
+    '''
+    divide non-negative integers, rounding half up
+    '''
+    return (2 * numerator + denominator) // (2 * denominator)
+
+
+def apply_vat(net):
+    return divide_rounded(net * (100 + VAT_PERCENT), 100)
+
+
+def format_money(amount):
+    return '{0:.4f}'.format(float(amount) / MONEY_SCALE)
+
+
+def parse_timestamp(day, time_):
+    '''
+    convert the date (e.g. '05.01.13') and time of a connection
+    '''
+    return datetime(2000 + int(day[6:8]), int(day[3:5]), int(day[0:2]),
+                    int(time_[0:2]), int(time_[3:5]), int(time_[6:8]))
+
+
+def parse_duration(duration):
+    minutes, seconds = duration.split(':')
+    return int(minutes) * 60 + int(seconds)
+
+
+class PdftotextExtractor:
+    '''
+    Extract the text of invoices by running `pdftotext` on each of them
+    '''
+
+    cache_key = '\0'.join(EXTRACTION_COMMAND_TEMPLATE)
+
+    def extract_lines(self, invoice_file):
+        '''
+        stream the text of the given .pdf file line by line while it is extracted
+        '''
+        extraction_cmd = []
+        extractor = None
+        error_file = None
+        error_msg = ''
+
+        #   assemble command (on a copy, the template has to stay reusable)
+        extraction_cmd = list(EXTRACTION_COMMAND_TEMPLATE)
+        extraction_cmd[extraction_cmd.index(INPUT_FILE_PLACEHOLDER)] = invoice_file
+        #   execute, collecting errors aside so they cannot block the output pipe
+        error_file = tempfile.TemporaryFile()
+        extractor = subprocess.Popen(extraction_cmd,
+                                     stdout=subprocess.PIPE,
+                                     stderr=error_file)
+        try:
+            for line in iter(extractor.stdout.readline, ''):
+                yield line
+        finally:
+            extractor.stdout.close()
+            extractor.wait()
+        #   handle errors
+        error_file.seek(0)
+        error_msg = error_file.read()
+        error_file.close()
+        if (extractor.returncode != 0) or error_msg:
+            raise IOError(str(error_msg))
+
+
+class PdfMinerExtractor:
+    '''
+    Extract the text of invoices in-process with the pure-Python `pdfminer`
+
+    There is no process to be spawned per invoice and the fonts loaded by the
+    resource manager are shared by all invoices, so an instance should live as
+    long as the process extracting them (see `get_extractor`). Like
+    `pdftotext -layout`, the text on the same height of a page is joined into a
+    single line, separated by at least the whitespace the parse patterns expect.
+    '''
+
+    def __init__(self):
+        # optional dependency, only required when this backend is chosen
+        import pdfminer
+        from pdfminer import layout, pdfinterp, converter, pdfpage, psparser
+
+        self.layout = layout
+        self.pdfpage = pdfpage
+        self.errors = (psparser.PSException,)
+        self.resource_manager = pdfinterp.PDFResourceManager(caching=True)
+        self.device = converter.PDFPageAggregator(self.resource_manager,
+                                                  laparams=layout.LAParams())
+        self.interpreter = pdfinterp.PDFPageInterpreter(self.resource_manager, self.device)
+        self.cache_key = 'pdfminer\0{0}\0{1}'.format(pdfminer.__version__, LINE_TOLERANCE)
+
+    def extract_lines(self, invoice_file):
+        '''
+        stream the text of the given .pdf file page by page
+        '''
+        try:
+            with open(invoice_file, 'rb') as pdf:
+                for page in self.pdfpage.PDFPage.get_pages(pdf):
+                    self.interpreter.process_page(page)
+                    for line in self._get_page_lines(self.device.get_result()):
+                        yield line
+        except self.errors as error:
+            raise IOError('Could not extract text from \'{0}\': {1}'.format(invoice_file, error))
+
+    def _get_page_lines(self, page_layout):
+        '''
+        assemble the text lines of a page, top to bottom, from its text boxes
+        '''
+        rows = []
+
+        for box in page_layout:
+            if not isinstance(box, self.layout.LTTextBox):
+                continue
+            for text_line in box:
+                text = text_line.get_text().strip()
+                if text:
+                    rows.append((-text_line.y0, text_line.x0, text))
+        rows.sort()
+
+        line = []
+        line_top = None
+        for top, left, text in rows:
+            if line and top - line_top > LINE_TOLERANCE:
+                yield self._join_line(line)
+                line = []
+            if not line:
+                line_top = top
+            line.append((left, text))
+        if line:
+            yield self._join_line(line)
+
+    def _join_line(self, line):
+        '''
+        join the text on the same height left to right, its order by height
+        within the tolerance is arbitrary
+        '''
+        line.sort()
+        return '   '.join(text for left, text in line).encode('utf-8') + '\n'
+
+
+EXTRACTORS = {'pdftotext': PdftotextExtractor,
+              'pdfminer': PdfMinerExtractor}
+# instances of the extraction backends of the current process
+_extractors = {}
+
+
+class ExtractionCache:
+    '''
+    On-disk cache of the compressed text extracted from invoices, keyed by the
+    content of the .pdf file and the extraction backend. Beyond the given size
+    the least recently used entries are evicted.
+    '''
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+    def _get_path(self, digest, extractor):
+        key = hashlib.sha256('\0'.join([digest, extractor.cache_key])).hexdigest()
+        return os.path.join(self.directory, key + EXTRACTION_CACHE_SUFFIX)
+
+    def extract_lines(self, invoice_file, digest, extractor):
+        '''
+        stream the text of the given invoice from the cache, extract and cache
+        it with the given backend if it has not been seen before
+        '''
+        path = self._get_path(digest, extractor)
+        try:
+            cached_file = gzip.open(path, 'rb')
+        except IOError:
+            return self._store(path, extractor.extract_lines(invoice_file))
+
+        # mark the entry as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return self._load(cached_file)
+
+    def _load(self, cached_file):
+        try:
+            for line in cached_file:
+                yield line
+        finally:
+            cached_file.close()
+
+    def _store(self, path, lines):
+        '''
+        pass the given lines through while writing them to the cache, the entry
+        is only added once the extraction has completed successfully
+        '''
+        temp_file = None
+        temp_path = None
+
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # created concurrently by another worker
+                pass
+        temp_file, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        os.close(temp_file)
+        temp_file = gzip.open(temp_path, 'wb')
+        try:
+            for line in lines:
+                temp_file.write(line)
+                yield line
+            temp_file.close()
+            os.rename(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                temp_file.close()
+                os.remove(temp_path)
+
+        self.evict()
+
+    def evict(self):
+        '''
+        remove the least recently used entries until the cache fits its size
+        '''
+        entries = []
+        cache_size = 0
+
+        for name in os.listdir(self.directory):
+            if not name.endswith(EXTRACTION_CACHE_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            cache_size += stat.st_size
+
+        for mtime, size, path in sorted(entries):
+            if cache_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            cache_size -= size
+
+
+class InvoiceParser:
+    '''
+    Parse the text extracted from an invoice line by line and accumulate each
+    connection into its connection type as soon as it has been read
+
+    The invoice of an account of several phone lines lists the connections of
+    each of them after a header naming its number. Given a factory of the
+    connection types of a line, every line is accumulated into connection
+    types of its own, so such an invoice is split in the same single pass.
+    '''
+
+    RECHNUNGSDATUM_PATTERN = re.compile('Rechnungsdatum: +(\d{2})\.(\d{2})\.(\d{4})')
+    SUBSCRIBER_PATTERN = re.compile('Rufnummer:? +(\+?\d[\d /-]*\d)')
+    # every connection line starts with date, time and type of the connection,
+    # the remainder is handed to the parse pattern of the matching type
+    CONNECTION_PATTERN = re.compile('(%(date)s) +(%(time)s) +(%(type)s)(.*)' % {'date': '\d{2}\.\d{2}\.\d{2}',
+                                    'time': '\d{2}:\d{2}:\d{2}',
+                                    'type': '\S+'})
+
+    def __init__(self, connection_types, create_connection_types=None):
+        '''
+        the given connection types take the connections not preceded by a line
+        header, without a factory line headers are ignored
+        '''
+        self.rechnungsdatum = None
+        self.create_connection_types = create_connection_types
+        self.patterns = dict((connection_type.type_, connection_type.get_parse_pattern())
+                             for connection_type in connection_types)
+        # subscriber -> connection types in order, by type and the number of
+        # connections by type
+        self.lines = {}
+        self.subscribers = []
+        self.select_subscriber(DEFAULT_SUBSCRIBER, connection_types)
+
+    def select_subscriber(self, subscriber, connection_types=None):
+        '''
+        accumulate the following connections into the connection types of the
+        given line, creating them on its first header
+        '''
+        if subscriber not in self.lines:
+            if connection_types is None:
+                connection_types = self.create_connection_types(subscriber)
+            self.lines[subscriber] = (connection_types,
+                                      dict((connection_type.type_, connection_type)
+                                           for connection_type in connection_types),
+                                      dict.fromkeys(self.patterns, 0))
+            self.subscribers.append(subscriber)
+        self.connection_types, self.num_connections = self.lines[subscriber][1:]
+
+    def feed(self, line):
+        '''
+        process a single line of the extracted text
+        '''
+        line_match = self.CONNECTION_PATTERN.search(line)
+        if line_match:
+            type_ = line_match.group(3)
+            pattern = self.patterns.get(type_)
+            if pattern is None:
+                return
+            match = pattern.match(line_match.group(4))
+            if match:
+                # the fields are kept as matched, converting them is left to
+                # summing up and storing the connections in bulk
+                self.connection_types[type_].details.append(line_match.group(1, 2) + match.groups())
+                self.num_connections[type_] += 1
+            return
+
+        if self.rechnungsdatum is None:
+            match = self.RECHNUNGSDATUM_PATTERN.search(line)
+            if match:
+                self.rechnungsdatum = date(int(match.group(3)), int(match.group(2)), int(match.group(1)))
+                return
+        if self.create_connection_types is not None:
+            match = self.SUBSCRIBER_PATTERN.search(line)
+            if match:
+                self.select_subscriber(match.group(1).translate(None, SUBSCRIBER_SEPARATORS))
+
+    def parse(self, lines):
+        '''
+        process the extracted text from an iterable of lines
+        '''
+        for line in lines:
+            self.feed(line)
+
+    def extract_rechnungsdatum(self):
+        if not self.rechnungsdatum:
+            raise LookupError('Could not extract the date of invoice!')
+        else:
+            return self.rechnungsdatum
+
+    def get_subscribers(self):
+        '''
+        return the lines of the invoice in order of appearance, connections not
+        preceded by a line header only make up a line if there are any or if
+        there is no other line
+        '''
+        return [subscriber for subscriber in self.subscribers
+                if subscriber != DEFAULT_SUBSCRIBER or len(self.subscribers) == 1 or
+                   any(self.lines[subscriber][2].values())]
+
+    def get_connection_types(self, subscriber):
+        return self.lines[subscriber][0]
+
+    def count_connections(self):
+        return sum(sum(num_connections.values()) for connection_types, by_type, num_connections
+                   in self.lines.values())
+
+    def get_warnings(self):
+        '''
+        return a warning for each connection type without any connections, on
+        how many lines if there are several
+        '''
+        subscribers = self.get_subscribers()
+        warnings = []
+
+        for type_ in sorted(self.patterns):
+            num_lines = sum(1 for subscriber in subscribers if not self.lines[subscriber][2][type_])
+            if not num_lines:
+                continue
+            if len(subscribers) == 1:
+                warnings.append(UserWarning('No connections of type {0}!'.format(type_)))
+            else:
+                warnings.append(UserWarning('No connections of type {0} on {1} of {2} '\
+                                            'lines!'.format(type_, num_lines, len(subscribers))))
+        return warnings
+
+
+def create_connection_types(subscriber=DEFAULT_SUBSCRIBER):
+    '''
+    create one instance of each connection type to accumulate the connections
+    of the given line
+    '''
+    return [Calls(ConnectionType.FESTNETZ, subscriber),
+            Calls(ConnectionType.NETZEXTERN, subscriber),
+            Calls(ConnectionType.NETZINTERN, subscriber),
+            TextMessages(subscriber),
+            MobileWebConnections(subscriber)]
+
+
+def parse_invoice(extracted_lines):
+    '''
+    build the billing date and the connection types of all of its lines from
+    the extracted lines, return it along with the warnings raised while parsing
+    '''
+    default_connection_types = []
+    connection_types = []
+    warnings = []
+
+    # process text extracted from pdf while it is being extracted, the time
+    # spent waiting for the extraction is accounted for separately
+    default_connection_types = create_connection_types()
+    extractor = InvoiceParser(default_connection_types, create_connection_types)
+    with instrumentation.stage('extract+parse'):
+        extractor.parse(instrumentation.timed_iter('extract', extracted_lines))
+    for subscriber in extractor.get_subscribers():
+        connection_types.extend(extractor.get_connection_types(subscriber))
+    with instrumentation.stage('totals'):
+        for connection_type in connection_types:
+            connection_type.update_totals()
+    instrumentation.count('matched_lines', extractor.count_connections())
+    warnings = extractor.get_warnings()
+
+    # add the connection types to the current billing date, those without a
+    # line are not registered
+    with instrumentation.stage('orm'):
+        for connection_type in default_connection_types:
+            if connection_type not in connection_types:
+                session.expunge(connection_type)
+        billing_date = BillingDate(extractor.extract_rechnungsdatum())
+        billing_date.connections.extend(connection_types)
+
+    return billing_date, warnings
+
+
+def hash_invoice(invoice_file):
+    '''
+    compute the SHA-256 digest of the content of the given .pdf file
+    '''
+    digest = hashlib.sha256()
+    with open(invoice_file, 'rb') as pdf:
+        for chunk in iter(lambda: pdf.read(HASH_CHUNK_SIZE), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_extractor(name=DEFAULT_EXTRACTOR):
+    '''
+    return the instance of the named extraction backend of the current process,
+    it is created on first use and then shared by all invoices extracted here
+    '''
+    if name not in _extractors:
+        _extractors[name] = EXTRACTORS[name]()
+    return _extractors[name]
+
+
+def extract_invoice_lines(invoice_file, digest, cache=None, extractor=DEFAULT_EXTRACTOR):
+    '''
+    stream the text of the given .pdf file, through the cache if there is one
+    '''
+    if cache is None:
+        return get_extractor(extractor).extract_lines(invoice_file)
+    return cache.extract_lines(invoice_file, digest, get_extractor(extractor))
+
+
+def add_invoice(invoice_file, cache=None, extractor=DEFAULT_EXTRACTOR):
+
+    digest = ''
+    invoice = None
+    billing_date = None
+    warnings = []
+
+    # skip invoices that have already been added before doing any work
+    try:
+        with instrumentation.stage('hash'):
+            digest = hash_invoice(invoice_file)
+    except IOError as error:
+        print "ERROR: %s" % str(error)
+        raise SystemExit(1)
+    with instrumentation.stage('lookup'):
+        invoice = InvoiceFile.get(digest)
+    if invoice:
+        print 'ERROR: Invoice \'{0}\' has already been added for billing date '\
+              '{1}'.format(invoice_file, invoice.billing_date)
+        raise SystemExit(1)
+
+    # extract text from .pdf and process it while streaming, the parsed
+    # billing date is only added once its lines have been checked
+    try:
+        billing_date, warnings = parse_invoice(extract_invoice_lines(invoice_file, digest, cache,
+                                                                     extractor))
+        session.expunge_all()
+        billing_date, connection_types = register_billing_date(billing_date,
+                                                               get_registered_lines(billing_date.date))
+    except (IOError, OSError) as error:
+        print "ERROR: %s" % str(error)
+        raise SystemExit(1)
+    except LookupError as error:
+        print 'ERROR: {0}'.format(error)
+        raise SystemExit(1)
+
+    for warning in warnings:
+        print 'WARNING: {0}'.format(warning)
+    InvoiceFile(digest, billing_date)
+    register_processed_file(invoice_file, digest)
+
+    # write results to data base
+    try:
+        with instrumentation.stage('stats'):
+            update_connection_stats(connection_types)
+        with instrumentation.stage('flush'):
+            session.flush()
+        with instrumentation.stage('details'):
+            add_connection_details(billing_date, connection_types)
+        with instrumentation.stage('commit'):
+            session.commit()
+    except IntegrityError as error:
+        print "ERROR: Could not add new connections to data base: {0}".format(error)
+        session.rollback()
+        raise SystemExit(1)
+
+    # feed added data back to user
+    print 'The following data has been registered for billing date {0}:'.format(billing_date.date)
+    print_connection_types(connection_types)
+
+
+def get_registered_lines(billing_date=None):
+    '''
+    return the lines registered per billing date, of all billing dates or of
+    the given one
+    '''
+    columns = ConnectionType.table.c
+    registered = {}
+    query = None
+
+    query = session.query(columns.date_date, columns.subscriber).distinct()
+    if billing_date is not None:
+        query = query.filter(columns.date_date == billing_date)
+    for date_, subscriber in query:
+        registered.setdefault(date_, set()).add(subscriber)
+    return registered
+
+
+def register_billing_date(billing_date, registered):
+    '''
+    add a parsed billing date to the session, given the lines registered so
+    far per billing date
+
+    The connection types of a date that has been registered for other lines
+    before are moved to the registered billing date. Return the billing date
+    and the added connection types, raise a LookupError if any of the lines
+    have already been registered for the date.
+    '''
+    connection_types = list(billing_date.connections)
+    subscribers = set(connection_type.subscriber for connection_type in connection_types)
+    duplicates = subscribers & registered.get(billing_date.date, set())
+
+    if duplicates:
+        raise LookupError('Billing date {0} has already been registered{1}'.format(billing_date.date,
+                          '' if duplicates == set([DEFAULT_SUBSCRIBER]) else
+                          ' for line(s) {0}'.format(', '.join(sorted(duplicates)))))
+
+    if billing_date.date in registered:
+        del billing_date.connections[:]
+        billing_date = BillingDate.get(billing_date.date)
+        for connection_type in connection_types:
+            connection_type.date = billing_date
+            session.add(connection_type)
+    else:
+        session.add(billing_date)
+    registered.setdefault(billing_date.date, set()).update(subscribers)
+    return billing_date, connection_types
+
+
+def print_connection_types(connection_types):
+    '''
+    print the given connection types, below the numbers of their lines
+    '''
+    for subscriber, line_connection_types in groupby(connection_types,
+                                                     lambda connection_type: connection_type.subscriber):
+        if subscriber != DEFAULT_SUBSCRIBER:
+            print 'Line {0}:'.format(subscriber)
+        for connection_type in line_connection_types:
+            print connection_type
+
+
+def add_connection_details(billing_date, connection_types=None):
+    '''
+    bulk insert the individual connections parsed for the given billing date,
+    of the given ones of its connection types or of all of them
+    '''
+    rows = []
+
+    if connection_types is None:
+        connection_types = billing_date.connections
+    for connection_type in connection_types:
+        for timestamp, destination, provider, duration, quantity, net in connection_type.get_connections():
+            rows.append({'billing_date': billing_date.date,
+                         'subscriber': connection_type.subscriber,
+                         'type_': connection_type.type_,
+                         'timestamp': timestamp,
+                         'destination': destination,
+                         'provider': provider,
+                         'duration': duration,
+                         'quantity': quantity,
+                         'net': net})
+            if len(rows) >= CONNECTIONS_PER_INSERT:
+                session.execute(connection_table.insert(), rows)
+                rows = []
+        # the connections have been handed over to the data base
+        connection_type.details = []
+        connection_type.totalled = 0
+
+    if rows:
+        session.execute(connection_table.insert(), rows)
+
+
+def _parse_invoice_file(job):
+    '''
+    extract and parse a single invoice in a worker process
+
+    The resulting billing date is detached from the worker's session, so it can
+    be handed back to the parent process and be committed there, along with the
+    timings of the job if they are being collected.
+    '''
+    invoice_file, digest, cache, extractor = job
+    timings = None
+
+    instrumentation.reset()
+    try:
+        billing_date, warnings = parse_invoice(extract_invoice_lines(invoice_file, digest, cache,
+                                                                     extractor))
+    except (IOError, OSError, LookupError) as error:
+        session.expunge_all()
+        return invoice_file, None, [], str(error), None
+
+    session.expunge_all()
+    if instrumentation.enabled:
+        timings = instrumentation.as_dict()
+    return invoice_file, billing_date, [str(warning) for warning in warnings], None, timings
+
+
+def find_invoice_files(invoice_dir):
+    '''
+    list the invoices in the given directory or matching the given glob pattern
+    '''
+    if os.path.isdir(invoice_dir):
+        invoice_dir = os.path.join(invoice_dir, INVOICE_FILE_PATTERN)
+    return sorted(glob.glob(invoice_dir))
+
+
+def get_file_signature(invoice_file):
+    '''
+    return modification time and size of the given file, which tell whether it
+    has changed since it was processed
+    '''
+    stat = os.stat(invoice_file)
+    return stat.st_mtime, stat.st_size
+
+
+def register_processed_file(invoice_file, digest, signature=None):
+    '''
+    add or update the manifest entry of the given file
+    '''
+    path = os.path.abspath(invoice_file)
+    processed_file = ProcessedFile.get(path) or ProcessedFile(path)
+    processed_file.mtime, processed_file.size = signature or get_file_signature(invoice_file)
+    processed_file.digest = digest
+
+
+def ingest_invoices(invoice_files, cache=None, extractor=DEFAULT_EXTRACTOR, ignored=None):
+    '''
+    add the given invoices that are new or have changed since they were
+    processed, parsing them in parallel
+
+    Unchanged files according to the manifest, as well as the given ignored
+    signatures by path, are skipped without being read. Return the added files
+    with their billing dates, the files skipped as their content has already
+    been added and the files that failed along with their errors.
+    '''
+    manifest = {}
+    signatures = {}
+    digests = {}
+    invoice = None
+    jobs = []
+    worker_pool = None
+    registered = {}
+    pending = []
+    added = []
+    skipped = []
+    failures = []
+
+    ignored = ignored or {}
+    manifest = dict((path, (mtime, size)) for path, mtime, size in
+                    session.query(ProcessedFile.path, ProcessedFile.mtime, ProcessedFile.size))
+
+    # skip invoices that have already been added before doing any work
+    for invoice_file in invoice_files:
+        path = os.path.abspath(invoice_file)
+        try:
+            signatures[invoice_file] = get_file_signature(invoice_file)
+        except OSError as error:
+            failures.append((invoice_file, str(error)))
+            continue
+        if signatures[invoice_file] in (manifest.get(path), ignored.get(path)):
+            continue
+
+        try:
+            with instrumentation.stage('hash'):
+                digests[invoice_file] = hash_invoice(invoice_file)
+        except IOError as error:
+            failures.append((invoice_file, str(error)))
+            continue
+        with instrumentation.stage('lookup'):
+            invoice = InvoiceFile.get(digests[invoice_file])
+        if invoice:
+            # added before, from another path or before it was touched
+            register_processed_file(invoice_file, digests[invoice_file], signatures[invoice_file])
+            skipped.append((invoice_file, invoice.billing_date))
+            continue
+        jobs.append((invoice_file, digests[invoice_file], cache, extractor))
+    session.commit()
+
+    if not jobs:
+        return added, skipped, failures
+
+    # lines are unique per billing date, so skip invoices that are already
+    # registered
+    registered = get_registered_lines()
+
+    def commit_pending():
+        try:
+            with instrumentation.stage('stats'):
+                for invoice_file, billing_date, connection_types in pending:
+                    update_connection_stats(connection_types)
+            with instrumentation.stage('flush'):
+                session.flush()
+            with instrumentation.stage('details'):
+                for invoice_file, billing_date, connection_types in pending:
+                    add_connection_details(billing_date, connection_types)
+            with instrumentation.stage('commit'):
+                session.commit()
+            added.extend(pending)
+        except IntegrityError as error:
+            session.rollback()
+            failures.extend((invoice_file, 'Could not add new connections to '\
+                                           'data base: {0}'.format(error))
+                            for invoice_file, billing_date, connection_types in pending)
+        del pending[:]
+
+    # extract and parse invoices in parallel, but write them from this process,
+    # the timings of the workers add up to more than the wall time passed;
+    # every worker sets up its extraction backend once for all of its invoices
+    worker_pool = multiprocessing.Pool(min(multiprocessing.cpu_count(), len(jobs)),
+                                       get_extractor, (extractor,))
+    try:
+        for invoice_file, billing_date, warnings, error, timings in \
+                worker_pool.imap_unordered(_parse_invoice_file, jobs):
+            if timings:
+                instrumentation.merge(timings)
+            for warning in warnings:
+                print 'WARNING: {0}: {1}'.format(invoice_file, warning)
+            if error:
+                failures.append((invoice_file, error))
+                continue
+            try:
+                billing_date, connection_types = register_billing_date(billing_date, registered)
+            except LookupError as error:
+                failures.append((invoice_file, str(error)))
+                continue
+
+            InvoiceFile(digests[invoice_file], billing_date)
+            register_processed_file(invoice_file, digests[invoice_file], signatures[invoice_file])
+            pending.append((invoice_file, billing_date, connection_types))
+            if len(pending) >= INVOICES_PER_TRANSACTION:
+                commit_pending()
+        commit_pending()
+    finally:
+        worker_pool.close()
+        worker_pool.join()
+
+    return added, skipped, failures
+
+
+def report_ingested_invoices(added, skipped, failures):
+    '''
+    feed the added data back to the user, list skipped and failed invoices
+    '''
+    for invoice_file, billing_date, connection_types in sorted(added, key=lambda entry: entry[1].date):
+        print 'The following data has been registered for billing date '\
+              '{0} ({1}):'.format(billing_date.date, invoice_file)
+        print_connection_types(connection_types)
+
+    for invoice_file, billing_date in sorted(skipped):
+        print 'Skipped \'{0}\', it has already been added for billing date '\
+              '{1}'.format(invoice_file, billing_date)
+    if failures:
+        print 'The following invoices could not be added:'
+        for invoice_file, error in sorted(failures):
+            print '   {0}: {1}'.format(invoice_file, error)
+
+
+def add_invoices(invoice_dir, cache=None, extractor=DEFAULT_EXTRACTOR):
+
+    invoice_files = []
+    added = []
+    skipped = []
+    failures = []
+
+    invoice_files = find_invoice_files(invoice_dir)
+    if not invoice_files:
+        print 'ERROR: No invoices found in \'{0}\''.format(invoice_dir)
+        raise SystemExit(1)
+
+    added, skipped, failures = ingest_invoices(invoice_files, cache, extractor)
+    report_ingested_invoices(added, skipped, failures)
+
+    print '\nAdded {0} of {1} invoices, skipped {2} unchanged or already added '\
+          'ones.'.format(len(added), len(invoice_files),
+                                                             len(invoice_files) - len(added) - len(failures))
+    if failures:
+        raise SystemExit(1)
+
+
+def watch_invoices(invoice_dir, interval, cache=None, extractor=DEFAULT_EXTRACTOR):
+    '''
+    add new and changed invoices in the given directory until interrupted
+
+    Invoices that failed are retried once they change, or after a restart.
+    '''
+    failed = {}
+    added = []
+    skipped = []
+    failures = []
+
+    print 'Watching \'{0}\' for new invoices every {1} seconds, '\
+          'interrupt to stop...'.format(invoice_dir, interval)
+    try:
+        while True:
+            added, skipped, failures = ingest_invoices(find_invoice_files(invoice_dir), cache,
+                                                       extractor, failed)
+            if added or skipped or failures:
+                print '\n{0:%Y-%m-%d %H:%M:%S}:'.format(datetime.now())
+                report_ingested_invoices(added, skipped, failures)
+            for invoice_file, error in failures:
+                try:
+                    failed[os.path.abspath(invoice_file)] = get_file_signature(invoice_file)
+                except OSError:
+                    pass
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        session.rollback()
+        print '\nStopped watching \'{0}\'.'.format(invoice_dir)
+
+
+def update_connection_stats(connection_types):
+    '''
+    add the given connection types of a new billing date to the statistics
+    '''
+    # fetched at once, there are as many connection types as lines per type
+    stats = dict((type_stats.type_, type_stats) for type_stats in ConnectionStatistics.query)
+
+    for connection_type in connection_types:
+        if connection_type.type_ not in stats:
+            stats[connection_type.type_] = ConnectionStatistics(connection_type.type_)
+        stats[connection_type.type_].add(connection_type.amount, connection_type.net,
+                                         connection_type.gross)
+
+
+def compute_connection_stats():
+    '''
+    compute the statistics of all connection types from scratch
+    '''
+    amount = ConnectionType.amount
+    stats = {}
+
+    # fetch the moments of all connection types in one go, the variance that
+    # sqlite cannot provide is derived from them
+    for type_, count, sum_, sum_of_squares, min_, max_, net, gross in \
+            session.query(ConnectionType.type_,
+                          func.count(amount),
+                          func.sum(amount),
+                          func.sum(amount * amount),
+                          func.min(amount),
+                          func.max(amount),
+                          func.avg(ConnectionType.net),
+                          func.avg(ConnectionType.gross)
+                         ).group_by(ConnectionType.type_):
+        mean = float(sum_) / count
+        stats[type_] = {'count': count,
+                        'mean': mean,
+                        'm2': max(float(sum_of_squares) - mean * sum_, 0.0),
+                        'min_': min_,
+                        'max_': max_,
+                        'net': net,
+                        'gross': gross}
+
+    return stats
+
+
+def store_connection_stats():
+    '''
+    add the statistics of all connection types computed from scratch to the
+    cache
+    '''
+    for type_, values in compute_connection_stats().items():
+        stats = ConnectionStatistics(type_)
+        for name, value in values.items():
+            setattr(stats, name, value)
+
+
+def fill_connection_stats():
+    '''
+    fill the cache of a data base holding billing dates from before the
+    statistics were cached, so that they are included once the statistics of
+    new billing dates are added to it
+    '''
+    if ConnectionStatistics.query.first() is not None or \
+            session.query(ConnectionType.type_).first() is None:
+        return
+    store_connection_stats()
+    session.commit()
+
+
+def rebuild_connection_stats():
+    '''
+    replace the cached statistics by a full recomputation
+    '''
+    ConnectionStatistics.query.delete()
+    store_connection_stats()
+    session.commit()
+
+    print 'Rebuilt statistics for {0} connection types.'.format(ConnectionStatistics.query.count())
+
+
+def check_connection_stats():
+    '''
+    compare the cached statistics against a full recomputation
+    '''
+    expected = compute_connection_stats()
+    cached = dict((stats.type_, stats) for stats in ConnectionStatistics.query)
+    consistent = True
+
+    for type_ in sorted(set(expected) | set(cached)):
+        if type_ not in cached or type_ not in expected:
+            print '   {0:<4}: MISSING {1}'.format(type_, 'in cache' if type_ not in cached else 'connections')
+            consistent = False
+            continue
+        mismatches = [name for name, value in sorted(expected[type_].items())
+                      if abs(getattr(cached[type_], name) - value) > 1e-6 * max(1.0, abs(value))]
+        if mismatches:
+            print '   {0:<4}: MISMATCH ({1})'.format(type_, ', '.join(mismatches))
+            consistent = False
+        else:
+            print '   {0:<4}: OK'.format(type_)
+
+    if not consistent:
+        print 'ERROR: The cached statistics are inconsistent, run --rebuild-stats'
+        raise SystemExit(1)
+
+
+def _count_statement(connection, cursor, statement, parameters, context, executemany):
+    instrumentation.count('sql_statements')
+
+
+def connect_to_db(data_base):
+
+    metadata.bind = 'sqlite:///{0}'.format(data_base)
+    event.listen(metadata.bind, 'before_cursor_execute', _count_statement)
+
+    #DEBUG
+    #metadata.bind.echo = True
+
+    # setup data base tables and object mappers
+    setup_all(True)
+    upgrade_data_base(data_base)
+    fill_connection_stats()
+
+
+def upgrade_data_base(data_base):
+    '''
+    migrate the data of a data base created by an earlier version, in a single
+    transaction along with its version
+    '''
+    connection = sqlite3.connect(data_base, isolation_level=None)
+    try:
+        version = connection.execute('PRAGMA user_version').fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+
+        connection.execute('BEGIN IMMEDIATE')
+        if version < 1:
+            # columns declared as FLOAT keep the integers in floating point
+            # representation, but store them as integers on disk
+            for table, columns in [('connection_type', ['net', 'gross']),
+                                   ('connection', ['net'])]:
+                connection.execute('UPDATE {0} SET {1}'.format(table, ', '.join('{0} = CAST(round({0} * {1}) AS INTEGER)'.format(column,
+                                                                                                                            MONEY_SCALE)
+                                                                              for column in columns)))
+            # the amounts are unchanged, but the mean prices have been rounded
+            connection.execute('UPDATE connection_statistics SET '\
+                               'net = (SELECT avg(net) FROM connection_type '\
+                               'WHERE connection_type.type_ = connection_statistics.type_), '\
+                               'gross = (SELECT avg(gross) FROM connection_type '\
+                               'WHERE connection_type.type_ = connection_statistics.type_)')
+        if version < 2:
+            # the line is part of the primary key of the connection types, so
+            # the tables are rebuilt, the data registered so far belongs to the
+            # line without a number
+            for table in [ConnectionType.table, Calls.table, TextMessages.table,
+                          MobileWebConnections.table, connection_table]:
+                rebuild_table(connection, table, DEFAULT_SUBSCRIBER)
+        if version < 3:
+            # the billing date of processed files is looked up by their digest
+            rebuild_table(connection, ProcessedFile.table, None)
+        connection.execute('PRAGMA user_version = {0}'.format(SCHEMA_VERSION))
+        connection.execute('COMMIT')
+    finally:
+        connection.close()
+
+
+def rebuild_table(connection, table, default):
+    '''
+    recreate the given table of an earlier layout in its current one, taking
+    over the columns it kept and setting the added ones to the given default
+    '''
+    dialect = metadata.bind.dialect
+    old_columns = [row[1] for row in connection.execute('PRAGMA table_info({0})'.format(table.name))]
+    columns = [column.name for column in table.columns]
+
+    if set(columns) == set(old_columns):
+        return
+
+    # keep the references of other tables to the name of the table
+    connection.execute('PRAGMA legacy_alter_table = ON')
+    connection.execute('ALTER TABLE {0} RENAME TO {0}_old'.format(table.name))
+    connection.execute(str(CreateTable(table).compile(dialect=dialect)))
+    connection.execute('INSERT INTO {0} ({1}) SELECT {2} FROM {0}_old'.format(table.name,
+                       ', '.join(columns),
+                       ', '.join(column if column in old_columns else '?' for column in columns)),
+                       [default] * len(set(columns) - set(old_columns)))
+    connection.execute('DROP TABLE {0}_old'.format(table.name))
+    for index in table.indexes:
+        connection.execute(str(CreateIndex(index).compile(dialect=dialect)))
+    connection.execute('PRAGMA legacy_alter_table = OFF')
@@ -0,0 +1,225 @@
+'''
+Read-only queries of the invoice data base on the stdlib `sqlite3` module,
+shared by the command line, the query server and the trend statistics.
+
+Only the first query on a data base of an earlier version loads the ORM, to
+upgrade it.
+'''
+
+import os
+import sqlite3
+from itertools import groupby
+from datetime import date
+
+from invoice_constants import MONEY_SCALE, SCHEMA_VERSION, FESTNETZ, NETZEXTERN, NETZINTERN, SMS, \
+                              INET
+
+
+# label of the line of invoices that do not name it
+DEFAULT_SUBSCRIBER_LABEL = '(no number)'
+
+# order, labels and units of the connection types in the statistics
+STATISTICS_LABELS = [(NETZEXTERN, 'net external calls', 'min'),
+                     (NETZINTERN, 'net internal calls', 'min'),
+                     (FESTNETZ, 'land line calls', 'min'),
+                     (SMS, 'short messages', 'SMS'),
+                     (INET, 'mobile traffic', 'kB')]
+CONNECTION_UNITS = dict((type_, unit) for type_, label, unit in STATISTICS_LABELS)
+
+
+def open_data_base(data_base, check_same_thread=True):
+    '''
+    open the data base for reading without loading the ORM, connections that
+    are not checked for being used by a single thread can be handed between
+    threads
+    '''
+    connection = None
+
+    if not os.path.isfile(data_base):
+        print 'ERROR: Could not open data base \'{0}\': no such file'.format(data_base)
+        raise SystemExit(1)
+
+    connection = sqlite3.connect(data_base, check_same_thread=check_same_thread)
+    if connection.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+        # only the first query on a data base of an earlier version pays for
+        # loading the ORM to upgrade it
+        connection.close()
+        print 'Upgrading data base \'{0}\'...'.format(data_base)
+        import invoice_database
+        invoice_database.connect_to_db(data_base)
+        invoice_database.session.close()
+        connection = sqlite3.connect(data_base, check_same_thread=check_same_thread)
+    connection.execute('PRAGMA query_only = ON')
+    return connection
+
+
+def to_euros(amount):
+    '''
+    convert an amount of money as stored in the data base
+    '''
+    return float(amount) / MONEY_SCALE
+
+
+def get_month_conditions(column, first_month=None, last_month=None):
+    '''
+    build the conditions on the given date column selecting the billing dates
+    from the given first through the given last month
+    '''
+    conditions = []
+    params = []
+
+    # compare against the first and last day rather than matching patterns,
+    # so the indexes on the dates can be used
+    if first_month:
+        conditions.append('{0} >= ?'.format(column))
+        params.append(first_month.isoformat())
+    if last_month:
+        conditions.append('{0} < ?'.format(column))
+        params.append(date(last_month.year + last_month.month // 12,
+                           last_month.month % 12 + 1, 1).isoformat())
+
+    return conditions, params
+
+
+def query_months(connection, first_month=None, last_month=None, subscriber=None):
+    '''
+    fetch the billing dates from the given first through the given last month
+    along with all of their connection types in a single statement, summed
+    over all lines or of the given line only
+    '''
+    conditions = []
+    params = []
+    rows = None
+
+    conditions, params = get_month_conditions('billing_date.date', first_month, last_month)
+    if subscriber is not None:
+        # only the months registered for the line, found by its index
+        conditions.append('connection_type.subscriber = ?')
+        params.append(subscriber)
+
+    rows = connection.execute('SELECT billing_date.date, connection_type.type_, '\
+                              'sum(connection_type.amount), sum(connection_type.net), '\
+                              'sum(connection_type.gross) '\
+                              'FROM billing_date LEFT OUTER JOIN connection_type '\
+                              'ON connection_type.date_date = billing_date.date '\
+                              '{0} GROUP BY billing_date.date, connection_type.type_ '\
+                              'ORDER BY billing_date.date, '\
+                              'min(connection_type.rowid)'.format('WHERE ' + ' AND '.join(conditions)
+                                                                  if conditions else ''),
+                              params)
+
+    return [(billing_date, [row[1:] for row in month_rows if row[1] is not None])
+            for billing_date, month_rows in groupby(rows, lambda row: row[0])]
+
+
+def query_months_by_line(connection, first_month=None, last_month=None):
+    '''
+    fetch the billing dates from the given first through the given last month
+    along with the connection types of each of their lines in a single
+    statement
+    '''
+    conditions = []
+    params = []
+    rows = None
+
+    conditions, params = get_month_conditions('date_date', first_month, last_month)
+    rows = connection.execute('SELECT date_date, subscriber, type_, amount, net, gross '\
+                              'FROM connection_type {0} '\
+                              'ORDER BY date_date, subscriber, rowid'.format('WHERE ' + ' AND '.join(conditions)
+                                                                             if conditions else ''),
+                              params)
+
+    return [(billing_date, [(subscriber, [row[2:] for row in line_rows])
+                            for subscriber, line_rows in groupby(month_rows, lambda row: row[1])])
+            for billing_date, month_rows in groupby(rows, lambda row: row[0])]
+
+
+def format_subscriber(subscriber):
+    return subscriber or DEFAULT_SUBSCRIBER_LABEL
+
+
+def get_stats_from_moments(count, sum_, sum_of_squares, min_, max_, net, gross):
+    '''
+    derive count, mean, M2, min, max and the mean net and gross amount from the
+    moments of the amounts, as sqlite cannot provide the variance
+    '''
+    mean = float(sum_) / count
+    return count, mean, max(float(sum_of_squares) - mean * sum_, 0.0), min_, max_, net, gross
+
+
+def fetch_connection_stats(connection):
+    '''
+    fetch count, mean, M2, min, max and the mean net and gross amount of each
+    connection type per line and month from the statistics cache, compute
+    them from the moments of all billing dates as long as the cache has not
+    been filled
+    '''
+    rows = []
+
+    try:
+        rows = connection.execute('SELECT type_, count, mean, m2, min_, max_, net, gross '\
+                                  'FROM connection_statistics').fetchall()
+    except sqlite3.OperationalError:
+        # data base from before the statistics were cached
+        pass
+    if rows:
+        return dict((row[0], row[1:]) for row in rows)
+
+    return query_connection_stats(connection)
+
+
+def query_connection_stats(connection, first_month=None, last_month=None):
+    '''
+    compute the statistics of each connection type over all lines from the
+    moments of the billing dates from the given first through the given last
+    month in a single statement
+    '''
+    conditions = []
+    params = []
+    stats = {}
+
+    conditions, params = get_month_conditions('date_date', first_month, last_month)
+    for row in connection.execute('SELECT type_, count(amount), sum(amount), sum(amount * amount), '\
+                                  'min(amount), max(amount), avg(net), avg(gross) '\
+                                  'FROM connection_type {0} '\
+                                  'GROUP BY type_'.format('WHERE ' + ' AND '.join(conditions)
+                                                          if conditions else ''),
+                                  params):
+        stats[row[0]] = get_stats_from_moments(*row[1:])
+
+    return stats
+
+
+def query_line_stats(connection, subscriber=None, first_month=None, last_month=None):
+    '''
+    compute the statistics of each connection type for each line, or for the
+    given line only, from the moments of their billing dates from the given
+    first through the given last month in a single statement
+    '''
+    conditions = []
+    params = []
+    stats = {}
+
+    conditions, params = get_month_conditions('date_date', first_month, last_month)
+    if subscriber is not None:
+        conditions.append('subscriber = ?')
+        params.append(subscriber)
+
+    for row in connection.execute('SELECT subscriber, type_, count(amount), sum(amount), '\
+                                  'sum(amount * amount), min(amount), max(amount), '\
+                                  'avg(net), avg(gross) FROM connection_type {0} '\
+                                  'GROUP BY subscriber, type_'.format('WHERE ' + ' AND '.join(conditions)
+                                                                      if conditions else ''),
+                                  params):
+        stats.setdefault(row[0], {})[row[1]] = get_stats_from_moments(*row[2:])
+
+    return stats
+
+
+def format_selection(subscriber=None, first_month=None, last_month=None):
+    '''
+    describe the line and the months statistics are restricted to
+    '''
+    return ''.join(['' if subscriber is None else ' for line {0}'.format(format_subscriber(subscriber)),
+                    '' if first_month is None else ' from \'{0:%Y-%m}\''.format(first_month),
+                    '' if last_month is None else ' through \'{0:%Y-%m}\''.format(last_month)])
@@ -0,0 +1,305 @@
+'''
+Local HTTP server answering the queries of `cell_invoice_analyser` as JSON.
+
+The server holds a pool of read-only connections to the data base, which is
+switched to write-ahead logging so that serving queries neither blocks nor is
+blocked by adding invoices from another process. Results are cached in memory
+until a change is committed to the data base, as told by `PRAGMA data_version`.
+
+    GET /months                 all billing dates
+    GET /range/FIRST/LAST       billing dates from month FIRST through LAST
+    GET /month/MONTH            billing date of MONTH
+    GET /statistics             statistics of the connection types
+    GET /lines                  registered lines
+
+Months are given as `YYYY-MM`. The months, the range, the month and the
+statistics take the parameters `line=NUMBER` and `by_line=1`, like the
+--line and --by-line options, the statistics also take `since=MONTH` and
+`until=MONTH` like the --since and --until options. Money is given in euros.
+'''
+
+import BaseHTTPServer
+import Queue
+import SocketServer
+import json
+import re
+import sqlite3
+import threading
+import urlparse
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date
+from math import sqrt
+
+from invoice_constants import SUBSCRIBER_SEPARATORS
+from invoice_queries import open_data_base, to_euros, query_months, query_months_by_line, \
+                            fetch_connection_stats, query_connection_stats, query_line_stats, \
+                            format_selection, CONNECTION_UNITS
+
+
+POOL_SIZE = 4
+RESULT_CACHE_SIZE = 1024
+MONTH_PATTERN = re.compile('(\d{4})-(\d{2})$')
+
+
+class ConnectionPool:
+    '''
+    Fixed number of read-only connections to the data base, handed to one
+    thread at a time
+    '''
+
+    def __init__(self, data_base, size):
+        self.connections = Queue.Queue()
+        for index in xrange(size):
+            self.connections.put(open_data_base(data_base, check_same_thread=False))
+
+    @contextmanager
+    def connection(self):
+        '''
+        borrow a connection for the enclosed block, waiting for one to be free
+        '''
+        connection = self.connections.get()
+        try:
+            yield connection
+        finally:
+            self.connections.put(connection)
+
+    def close(self):
+        while not self.connections.empty():
+            self.connections.get_nowait().close()
+
+
+class ResultCache:
+    '''
+    Least recently used results by request, dropped as soon as the given
+    connection sees a change committed to the data base
+    '''
+
+    def __init__(self, connection, max_size):
+        self.connection = connection
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.results = OrderedDict()
+        self.data_version = None
+
+    def get(self, key, compute):
+        '''
+        return the cached result of the given key and whether it was cached,
+        compute it if it is missing
+        '''
+        with self.lock:
+            data_version = self.connection.execute('PRAGMA data_version').fetchone()[0]
+            if data_version != self.data_version:
+                self.results.clear()
+                self.data_version = data_version
+            if key in self.results:
+                # mark the result as recently used
+                self.results[key] = self.results.pop(key)
+                return self.results[key], True
+
+        result = compute()
+        with self.lock:
+            # a result computed before a change is dropped on the next lookup
+            if data_version == self.data_version:
+                self.results[key] = result
+                if len(self.results) > self.max_size:
+                    self.results.popitem(last=False)
+        return result, False
+
+    def close(self):
+        self.connection.close()
+
+
+class QueryServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, data_base, pool_size):
+        self.cache = ResultCache(open_data_base(data_base, check_same_thread=False),
+                                 RESULT_CACHE_SIZE)
+        self.pool = ConnectionPool(data_base, pool_size)
+        BaseHTTPServer.HTTPServer.__init__(self, address, QueryHandler)
+
+    def server_close(self):
+        BaseHTTPServer.HTTPServer.server_close(self)
+        self.pool.close()
+        self.cache.close()
+
+
+class QueryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # keep the connections of clients open between requests
+    protocol_version = 'HTTP/1.1'
+    # send the headers and the body at once, separate small writes to a kept
+    # open connection are delayed until the client acknowledges the first
+    wbufsize = -1
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        params = dict((name, values[-1]) for name, values in urlparse.parse_qs(url.query).items())
+        key = (tuple(parts), tuple(sorted(params.items())))
+
+        try:
+            query = self.get_query(parts, params)
+            body, cached = self.server.cache.get(key, lambda: self.run_query(query))
+        except LookupError as error:
+            self.send_json(404, json.dumps({'error': str(error)}))
+        except ValueError as error:
+            self.send_json(400, json.dumps({'error': str(error)}))
+        except sqlite3.Error as error:
+            self.send_json(500, json.dumps({'error': str(error)}))
+        except Exception as error:
+            # answer rather than dropping the kept open connection of the client
+            self.send_json(500, json.dumps({'error': 'Internal error: {0}'.format(error)}))
+        else:
+            self.send_json(200, body, cached)
+
+    def get_query(self, parts, params):
+        '''
+        return the function answering the requested query along with its
+        arguments
+        '''
+        subscriber = params.get('line')
+        by_line = params.get('by_line') in ('1', 'true')
+
+        if subscriber is not None:
+            if by_line:
+                raise ValueError('line and by_line are mutually exclusive')
+            subscriber = subscriber.translate(None, SUBSCRIBER_SEPARATORS)
+
+        if parts == ['months']:
+            return get_months, (None, None, subscriber, by_line)
+        elif len(parts) == 3 and parts[0] == 'range':
+            return get_months, (parse_month(parts[1]), parse_month(parts[2]), subscriber, by_line)
+        elif len(parts) == 2 and parts[0] == 'month':
+            return get_month, (parse_month(parts[1]), subscriber, by_line)
+        elif parts == ['statistics']:
+            return get_statistics, (subscriber, by_line,
+                                    parse_month(params['since']) if 'since' in params else None,
+                                    parse_month(params['until']) if 'until' in params else None)
+        elif parts == ['lines']:
+            return get_lines, ()
+        raise LookupError('Unknown query \'{0}\''.format(self.path))
+
+    def run_query(self, query):
+        function, args = query
+        with self.server.pool.connection() as connection:
+            return json.dumps(function(connection, *args), sort_keys=True)
+
+    def send_json(self, status, body, cached=False):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-Cache', 'hit' if cached else 'miss')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # requests are not logged, the server is meant to be hit frequently
+        pass
+
+
+def parse_month(month):
+    # `datetime.strptime` is not thread-safe on its first call, which imports
+    # a module, so the month is parsed by hand like on the command line
+    match = MONTH_PATTERN.match(month)
+    try:
+        if match is None:
+            raise ValueError('expected YYYY-MM')
+        return date(int(match.group(1)), int(match.group(2)), 1)
+    except ValueError as error:
+        raise ValueError('\'{0}\' is not a valid year-month combination: {1}'.format(month, error))
+
+
+def format_connection_types(connection_types):
+    return [{'type': type_, 'amount': amount, 'unit': CONNECTION_UNITS[type_],
+             'net': to_euros(net), 'gross': to_euros(gross)}
+            for type_, amount, net, gross in connection_types]
+
+
+def format_months(months, by_line):
+    if by_line:
+        return [{'billing_date': billing_date,
+                 'lines': [{'line': subscriber, 'connection_types': format_connection_types(connection_types)}
+                           for subscriber, connection_types in lines]}
+                for billing_date, lines in months]
+    return [{'billing_date': billing_date, 'connection_types': format_connection_types(connection_types)}
+            for billing_date, connection_types in months]
+
+
+def format_stats(stats):
+    return dict((type_, {'count': count, 'mean': mean, 'stdev': sqrt(m2 / count), 'min': min_,
+                         'max': max_, 'net': to_euros(net), 'gross': to_euros(gross)})
+                for type_, (count, mean, m2, min_, max_, net, gross) in stats.items())
+
+
+def get_months(connection, first_month, last_month, subscriber, by_line):
+    if by_line:
+        return format_months(query_months_by_line(connection, first_month, last_month), by_line)
+    return format_months(query_months(connection, first_month, last_month, subscriber), by_line)
+
+
+def get_month(connection, month, subscriber, by_line):
+    months = get_months(connection, month, month, subscriber, by_line)
+    if len(months) != 1:
+        raise LookupError('{0} billing dates registered for month \'{1:%Y-%m}\''.format(len(months),
+                                                                                       month))
+    return months[0]
+
+
+def get_statistics(connection, subscriber, by_line, first_month, last_month):
+    if by_line:
+        return dict((line, format_stats(stats)) for line, stats
+                    in query_line_stats(connection, None, first_month, last_month).items())
+    if subscriber is not None:
+        stats = query_line_stats(connection, subscriber, first_month, last_month).get(subscriber)
+    elif first_month is not None or last_month is not None:
+        stats = query_connection_stats(connection, first_month, last_month)
+    else:
+        return format_stats(fetch_connection_stats(connection))
+    if not stats:
+        raise LookupError('No billing dates registered{0}'.format(format_selection(subscriber, first_month,
+                                                                                    last_month)))
+    return format_stats(stats)
+
+
+def get_lines(connection):
+    return [{'line': subscriber, 'months': num_months, 'first': first_date, 'last': last_date}
+            for subscriber, num_months, first_date, last_date in connection.execute(
+                'SELECT subscriber, count(DISTINCT date_date), min(date_date), max(date_date) '\
+                'FROM connection_type GROUP BY subscriber ORDER BY subscriber')]
+
+
+def enable_write_ahead_log(data_base):
+    '''
+    switch the data base to write-ahead logging, which it keeps from then on,
+    return the journal mode in effect
+    '''
+    connection = sqlite3.connect(data_base)
+    try:
+        return connection.execute('PRAGMA journal_mode = WAL').fetchone()[0]
+    finally:
+        connection.close()
+
+
+def serve(data_base, address, port, pool_size=POOL_SIZE):
+    '''
+    answer queries on the given address and port until interrupted
+    '''
+    server = None
+
+    # opening the data base checks for it and upgrades it if needed
+    open_data_base(data_base).close()
+    if enable_write_ahead_log(data_base) != 'wal':
+        print 'WARNING: Could not enable write-ahead logging, queries may block adding invoices'
+    server = QueryServer((address, port), data_base, pool_size)
+
+    print 'Serving data base \'{0}\' on http://{1}:{2}/, interrupt to stop...'.format(data_base,
+                                                                                  *server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print '\nStopped serving \'{0}\'.'.format(data_base)
+    finally:
+        server.server_close()
@@ -0,0 +1,227 @@
+'''
+Simulation of the costs of candidate tariffs over the registered usage.
+
+The usage is loaded into NumPy arrays once, as a histogram of the usage of the
+individual connections per billing date, line and connection type, and every
+plan is then evaluated on it without looping over months, lines or
+connections. Every line is costed as a contract of its own, i.e. it is charged
+the base fee and granted the allowances in each month it is registered for,
+and the costs of the lines are summed up per month. Lines whose
+individual connections were not stored for a billing date, such as those added
+before they were, fall back to the billed amounts of that billing date.
+
+Plans are read from a JSON file holding a list of objects such as
+
+    {"name": "Allnet S",
+     "base_fee": 9.95,
+     "rates": {"calls": 0.09, "SMS": 0.09, "GPRS": 0.0049},
+     "included": {"calls": 100, "GPRS": null},
+     "increments": {"calls": 60, "GPRS": 10},
+     "net": false}
+
+Rates are charged per unit of the connection type (minute, SMS or kB) beyond
+the monthly allowance in `included`, where `null` stands for a flat rate.
+`increments` sets the billing increment in seconds or kB. `calls` is short
+for all call types, except in `included`, where it is a single allowance
+shared by them; the minutes beyond it are charged at the rate of each call
+type in proportion to its share of the minutes. Prices include VAT unless
+`net` is set.
+'''
+
+import json
+
+import numpy as np
+
+from invoice_constants import VAT_FACTOR, FESTNETZ, NETZEXTERN, NETZINTERN, SMS, INET, CALL_TYPES
+
+
+TARIFF_TYPES = CALL_TYPES + [SMS, INET]
+# usage is stored in seconds, SMS and kB, charged per minute, SMS and kB
+UNIT_SIZES = {FESTNETZ: 60, NETZEXTERN: 60, NETZINTERN: 60, SMS: 1, INET: 1}
+DEFAULT_INCREMENTS = {FESTNETZ: 60, NETZEXTERN: 60, NETZINTERN: 60, SMS: 1, INET: 100}
+
+
+class Usage:
+    '''
+    Histogram of the usage of the individual connections, i.e. the number of
+    connections of each usage per billing date, line and connection type, plus
+    the billed amounts of the lines without individual connections
+
+    The billing dates and lines are flattened into cells, the cell of a month
+    and line being `month * len(lines) + line`.
+    '''
+
+    def __init__(self, months, lines, registered, histograms, amounts):
+        self.months = months
+        self.lines = lines
+        # whether a line is registered per cell, i.e. charged the base fee
+        self.registered = registered
+        # type -> (cell indices, usages, counts)
+        self.histograms = histograms
+        # billed amounts per cell and type of lines without connections
+        self.amounts = amounts
+        self._billed = {}
+
+    def get_billed(self, type_, increment):
+        '''
+        return the usage of the given type per cell, each connection rounded up
+        to the given increment and converted to units charged for
+        '''
+        if (type_, increment) not in self._billed:
+            cell_indices, usages, counts = self.histograms[type_]
+            billed = np.ceil(usages / float(increment)) * increment * counts
+            self._billed[(type_, increment)] = np.bincount(cell_indices, weights=billed,
+                                                           minlength=len(self.registered)) / UNIT_SIZES[type_] \
+                                               + self.amounts[:, TARIFF_TYPES.index(type_)]
+        return self._billed[(type_, increment)]
+
+
+class Plans:
+    '''
+    Parameters of the candidate plans as arrays, one row per plan and one
+    column per connection type
+    '''
+
+    def __init__(self, plans):
+        self.names = []
+        self.base_fees = np.zeros(len(plans))
+        self.rates = np.zeros((len(plans), len(TARIFF_TYPES)))
+        self.allowances = np.zeros((len(plans), len(TARIFF_TYPES)))
+        # allowance shared by all call types
+        self.call_allowances = np.zeros(len(plans))
+        self.increments = np.zeros((len(plans), len(TARIFF_TYPES)), dtype=np.int64)
+        self.vat_factors = np.ones(len(plans))
+
+        for index, plan in enumerate(plans):
+            name = plan.get('name', 'plan {0}'.format(index + 1))
+            rates = expand_types(plan.get('rates', {}), name)
+            included = dict(plan.get('included', {}))
+            call_allowance = included.pop('calls', 0)
+            included = expand_types(included, name)
+            increments = dict(DEFAULT_INCREMENTS)
+            increments.update(expand_types(plan.get('increments', {}), name))
+
+            self.names.append(name)
+            self.base_fees[index] = plan.get('base_fee', 0.0)
+            self.call_allowances[index] = np.inf if call_allowance is None else call_allowance
+            for column, type_ in enumerate(TARIFF_TYPES):
+                flat_rate = included.get(type_, 0) is None or \
+                            (type_ in CALL_TYPES and call_allowance is None)
+                if type_ not in rates and not flat_rate:
+                    raise ValueError('Plan \'{0}\' has neither a rate nor a flat rate '\
+                                     'for {1}'.format(name, type_))
+                if increments[type_] < 1:
+                    raise ValueError('Plan \'{0}\' has an invalid increment for '\
+                                     '{1}'.format(name, type_))
+                self.rates[index, column] = rates.get(type_, 0.0)
+                allowance = included.get(type_, 0)
+                self.allowances[index, column] = np.inf if allowance is None else allowance
+                self.increments[index, column] = increments[type_]
+            if plan.get('net'):
+                self.vat_factors[index] = plan.get('vat_factor', VAT_FACTOR)
+
+
+def expand_types(values, name):
+    '''
+    expand the shorthand `calls` to all call types and validate the types
+    '''
+    expanded = {}
+    for type_, value in values.items():
+        if type_ == 'calls':
+            expanded.update(dict.fromkeys(CALL_TYPES, value))
+        elif type_ in TARIFF_TYPES:
+            expanded[type_] = value
+        else:
+            raise ValueError('Plan \'{0}\' refers to unknown connection type '\
+                             '\'{1}\''.format(name, type_))
+    return expanded
+
+
+def load_plans(plans_file):
+    with open(plans_file) as plans:
+        try:
+            return Plans(json.load(plans))
+        except (AttributeError, TypeError) as error:
+            raise ValueError('Malformed plans: {0}'.format(error))
+
+
+def load_usage(connection, subscriber=None):
+    '''
+    load the usage histogram and the billed amounts of the lines without
+    individual connections from the data base, of all lines or of the given
+    line only
+    '''
+    condition = '' if subscriber is None else 'WHERE subscriber = ?'
+    params = () if subscriber is None else (subscriber,)
+    registered_lines = connection.execute('SELECT DISTINCT date_date, subscriber FROM connection_type '\
+                                          '{0} ORDER BY date_date, subscriber'.format(condition),
+                                          params).fetchall()
+    months = sorted(set(billing_date for billing_date, line in registered_lines))
+    lines = sorted(set(line for billing_date, line in registered_lines))
+    month_indices = dict((billing_date, index) for index, billing_date in enumerate(months))
+    line_indices = dict((line, index) for index, line in enumerate(lines))
+    rows = {}
+
+    def get_cell(billing_date, line):
+        return month_indices[billing_date] * len(lines) + line_indices[line]
+
+    registered = np.zeros(len(months) * len(lines), dtype=bool)
+    for billing_date, line in registered_lines:
+        registered[get_cell(billing_date, line)] = True
+
+    for billing_date, line, type_, usage, count in connection.execute(
+            'SELECT billing_date, subscriber, type_, CASE WHEN type_ IN (?, ?) THEN quantity '\
+            'ELSE duration END AS usage, count(*) FROM connection {0} '\
+            'GROUP BY billing_date, subscriber, type_, usage'.format(condition), (SMS, INET) + params):
+        if type_ in UNIT_SIZES:
+            rows.setdefault(type_, []).append((get_cell(billing_date, line), usage or 0, count))
+
+    # billing dates added before the individual connections were stored
+    amounts = np.zeros((len(registered), len(TARIFF_TYPES)))
+    for billing_date, line, type_, amount in connection.execute(
+            'SELECT date_date, subscriber, type_, amount FROM connection_type {0} NOT EXISTS '\
+            '(SELECT 1 FROM connection WHERE connection.subscriber = connection_type.subscriber '\
+            'AND connection.billing_date = connection_type.date_date)'.format(condition + ' AND'
+                                                                              if condition else 'WHERE'),
+            params):
+        if type_ in UNIT_SIZES:
+            amounts[get_cell(billing_date, line), TARIFF_TYPES.index(type_)] += amount
+
+    histograms = {}
+    for type_ in TARIFF_TYPES:
+        columns = zip(*rows.get(type_, [])) or [[], [], []]
+        histograms[type_] = (np.array(columns[0], dtype=np.int64),
+                             np.array(columns[1], dtype=np.float64),
+                             np.array(columns[2], dtype=np.float64))
+    return Usage(months, lines, registered, histograms, amounts)
+
+
+def simulate(usage, plans):
+    '''
+    compute the gross costs of all plans per month, summed over the lines, as
+    an array with one row per plan and one column per month
+    '''
+    # the base fee is charged and the allowances are granted per line
+    costs = plans.base_fees[:, np.newaxis] * usage.registered
+    calls = {}
+
+    for column, type_ in enumerate(TARIFF_TYPES):
+        # the usage is rounded once per distinct increment, not once per plan
+        increments, inverse = np.unique(plans.increments[:, column], return_inverse=True)
+        billed = np.vstack([usage.get_billed(type_, increment) for increment in increments])[inverse]
+        charged = np.maximum(billed - plans.allowances[:, column, np.newaxis], 0.0)
+        if type_ in CALL_TYPES:
+            calls[column] = charged
+        else:
+            costs += charged * plans.rates[:, column, np.newaxis]
+
+    # the shared allowance of calls is taken from each call type in proportion
+    # to its minutes
+    total_calls = sum(calls.values())
+    excess = np.maximum(total_calls - plans.call_allowances[:, np.newaxis], 0.0)
+    shares = np.divide(excess, total_calls, out=np.zeros_like(excess), where=total_calls > 0)
+    for column, charged in calls.items():
+        costs += charged * shares * plans.rates[:, column, np.newaxis]
+
+    costs = costs.reshape(len(plans.names), len(usage.months), len(usage.lines)).sum(axis=2)
+    return costs * plans.vat_factors[:, np.newaxis]
@@ -0,0 +1,57 @@
+'''
+Data bases of synthetic EVNs shared by the tests.
+'''
+
+import os
+import sys
+from datetime import date
+
+BASE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path[:0] = [BASE_DIR, os.path.join(BASE_DIR, 'benchmarks')]
+
+import invoice_database
+from evn_generator import generate_lines
+
+
+class NullOutput:
+
+    def write(self, data):
+        pass
+
+
+def get_billing_date(month):
+    return date(2012 + month // 12, month % 12 + 1, 5)
+
+
+def add_invoice_lines(lines):
+    '''
+    parse and register the given lines of an EVN like `-a` does, return the
+    billing date and the added connection types
+    '''
+    billing_date, warnings = invoice_database.parse_invoice(lines)
+    invoice_database.session.expunge_all()
+    billing_date, connection_types = invoice_database.register_billing_date(
+        billing_date, invoice_database.get_registered_lines(billing_date.date))
+    invoice_database.update_connection_stats(connection_types)
+    invoice_database.session.flush()
+    invoice_database.add_connection_details(billing_date, connection_types)
+    invoice_database.session.commit()
+    return billing_date, connection_types
+
+
+def create_data_base(data_base, num_months, num_lines=20, subscribers=None):
+    '''
+    add a generated EVN for each of the given number of months, return the
+    lines of each of them
+    '''
+    invoices = []
+
+    invoice_database.connect_to_db(data_base)
+    try:
+        for month in xrange(num_months):
+            invoices.append(list(generate_lines(num_lines, billing_date=get_billing_date(month),
+                                                seed=month, subscribers=subscribers)))
+            add_invoice_lines(invoices[-1])
+    finally:
+        invoice_database.session.close()
+    return invoices
@@ -0,0 +1,57 @@
+'''
+The in-process extraction backend joins the text on the same height of a
+page into lines the parse patterns match.
+'''
+
+import unittest
+
+import helpers  # puts the modules under test on the import path
+import invoice_database
+
+try:
+    import pdfminer
+except ImportError:
+    pdfminer = None
+
+
+class TextLine:
+
+    def __init__(self, x0, y0, text):
+        self.x0 = x0
+        self.y0 = y0
+        self.text = text
+
+    def get_text(self):
+        return self.text
+
+
+@unittest.skipIf(pdfminer is None, 'requires pdfminer')
+class PdfMinerLinesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.extractor = invoice_database.PdfMinerExtractor()
+
+        class TextBox(list, self.extractor.layout.LTTextBox):
+            def __init__(self, text_lines):
+                list.__init__(self, text_lines)
+        self.TextBox = TextBox
+
+    def test_line_ordered_left_to_right(self):
+        # the price is set slightly higher than the rest of its row
+        page = [self.TextBox([TextLine(10, 700, u'05.01.13'), TextLine(60, 700, u'10:00:00'),
+                              TextLine(110, 700, u'NX'), TextLine(150, 700, u'01701234567'),
+                              TextLine(230, 700, u'O2'), TextLine(280, 700, u'1:00'),
+                              TextLine(400, 700.8, u'0,0756')]),
+                self.TextBox([TextLine(10, 680, u'Seite 2')])]
+        lines = list(self.extractor._get_page_lines(page))
+
+        self.assertEqual(lines, ['05.01.13   10:00:00   NX   01701234567   O2   1:00   0,0756\n',
+                                 'Seite 2\n'])
+        parser = invoice_database.InvoiceParser(invoice_database.create_connection_types())
+        parser.parse(lines)
+        self.assertEqual(parser.count_connections(), 1)
+        invoice_database.session.expunge_all()
+
+
+if __name__ == '__main__':
+    unittest.main()
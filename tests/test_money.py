@@ -0,0 +1,85 @@
+'''
+The net and gross totals stored per connection type are exact, i.e. the net
+total is the sum of the prices on the invoice and VAT is applied to it once.
+'''
+
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from decimal import Decimal, ROUND_HALF_UP
+
+from helpers import create_data_base, get_billing_date
+
+from evn_generator import generate_subscribers
+from invoice_constants import MONEY_SCALE, VAT_PERCENT, SUBSCRIBER_SEPARATORS
+
+
+NUM_MONTHS = 3
+NUM_LINES = 2000
+
+SUBSCRIBER_PATTERN = re.compile('Rufnummer: (.*)$')
+CONNECTION_PATTERN = re.compile('\d{2}\.\d{2}\.\d{2} +\d{2}:\d{2}:\d{2} +(\S+) .* (\d+,\d{4})$')
+
+
+def sum_prices(lines):
+    '''
+    return the exact sum of the prices on the given lines of an EVN per line
+    and connection type
+    '''
+    totals = {}
+    subscriber = None
+
+    for line in ''.join(lines).splitlines():
+        match = SUBSCRIBER_PATTERN.match(line)
+        if match:
+            subscriber = match.group(1).translate(None, SUBSCRIBER_SEPARATORS)
+            continue
+        match = CONNECTION_PATTERN.match(line)
+        if match:
+            key = (subscriber, match.group(1))
+            totals[key] = totals.get(key, Decimal(0)) + Decimal(match.group(2).replace(',', '.'))
+    return totals
+
+
+class MoneyTotalsTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.temp_dir = tempfile.mkdtemp()
+        data_base = os.path.join(cls.temp_dir, 'money.db')
+        cls.invoices = create_data_base(data_base, NUM_MONTHS, num_lines=NUM_LINES,
+                                        subscribers=generate_subscribers(3))
+        connection = sqlite3.connect(data_base)
+        try:
+            cls.totals = dict(((billing_date, subscriber, type_), (net, gross))
+                              for billing_date, subscriber, type_, net, gross in connection.execute(
+                                  'SELECT date_date, subscriber, type_, net, gross FROM connection_type'))
+        finally:
+            connection.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.temp_dir)
+
+    def test_totals_exact(self):
+        vat_factor = Decimal(100 + VAT_PERCENT) / 100
+        num_totals = 0
+
+        for month, lines in enumerate(self.invoices):
+            billing_date = str(get_billing_date(month))
+            for (subscriber, type_), total in sum_prices(lines).items():
+                net = total * MONEY_SCALE
+                gross = (net * vat_factor).quantize(Decimal(1), rounding=ROUND_HALF_UP)
+                self.assertEqual(self.totals[(billing_date, subscriber, type_)],
+                                 (int(net), int(gross)))
+                num_totals += 1
+
+        # connection types without connections are stored as well
+        self.assertEqual(num_totals, len([stored for stored in self.totals.values() if stored[0]]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+'''
+The month queries issue a single statement, however many billing dates and
+connection types they return.
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from helpers import NullOutput, create_data_base, get_billing_date
+
+import cell_invoice_analyser
+import invoice_queries
+from evn_generator import generate_subscribers
+from instrumentation import Instrumentation, CountingConnection
+
+
+NUM_MONTHS = 12
+
+
+class MonthQueryTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.temp_dir = tempfile.mkdtemp()
+        cls.data_bases = {}
+        for num_months in (1, NUM_MONTHS):
+            cls.data_bases[num_months] = os.path.join(cls.temp_dir, '{0}.db'.format(num_months))
+            create_data_base(cls.data_bases[num_months], num_months,
+                             subscribers=generate_subscribers(3))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.temp_dir)
+
+    def count_statements(self, num_months, query, *args):
+        '''
+        run the given query on a data base of the given number of billing
+        dates, return the number of statements it issued
+        '''
+        instrumentation = Instrumentation()
+        instrumentation.enabled = True
+        connection = invoice_queries.open_data_base(self.data_bases[num_months])
+        stdout = sys.stdout
+        sys.stdout = NullOutput()
+        try:
+            query(CountingConnection(connection, instrumentation), *args)
+        finally:
+            sys.stdout = stdout
+            connection.close()
+        return instrumentation.counters.get('sql_statements', 0)
+
+    def test_get_month(self):
+        for num_months in (1, NUM_MONTHS):
+            month = get_billing_date(num_months - 1)
+            self.assertEqual(self.count_statements(num_months, cell_invoice_analyser.get_month,
+                                                   month), 1)
+            self.assertEqual(self.count_statements(num_months, cell_invoice_analyser.get_month,
+                                                   month, None, True), 1)
+
+    def test_get_all_months(self):
+        for num_months in (1, NUM_MONTHS):
+            self.assertEqual(self.count_statements(num_months,
+                                                   cell_invoice_analyser.get_all_months), 1)
+            self.assertEqual(self.count_statements(num_months, cell_invoice_analyser.get_all_months,
+                                                   None, None, None, True), 1)
+
+    def test_get_range(self):
+        self.assertEqual(self.count_statements(NUM_MONTHS, cell_invoice_analyser.get_all_months,
+                                               get_billing_date(2), get_billing_date(8)), 1)
+
+    def test_all_months_returned(self):
+        connection = invoice_queries.open_data_base(self.data_bases[NUM_MONTHS])
+        try:
+            months = invoice_queries.query_months(connection)
+        finally:
+            connection.close()
+        self.assertEqual([billing_date for billing_date, connection_types in months],
+                         [str(get_billing_date(month)) for month in xrange(NUM_MONTHS)])
+        self.assertTrue(all(len(connection_types) == 5 for billing_date, connection_types in months))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+'''
+A freshly started query server answers concurrent first requests, each with an
+HTTP response.
+'''
+
+import httplib
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from helpers import BASE_DIR, create_data_base
+
+from evn_generator import generate_subscribers
+
+
+NUM_MONTHS = 9
+NUM_CLIENTS = 16
+NUM_STARTS = 3
+SERVER_START_TIMEOUT = 30
+
+
+def get_free_port():
+    probe = socket.socket()
+    try:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+    finally:
+        probe.close()
+
+
+class ServerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.temp_dir = tempfile.mkdtemp()
+        cls.data_base = os.path.join(cls.temp_dir, 'server.db')
+        create_data_base(cls.data_base, NUM_MONTHS, subscribers=generate_subscribers(2))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.temp_dir)
+
+    def start_server(self):
+        '''
+        start the server in a process of its own, return the process and the
+        port it serves on once it accepts connections
+        '''
+        port = get_free_port()
+        with open(os.devnull, 'w') as null:
+            server = subprocess.Popen([sys.executable, os.path.join(BASE_DIR, 'cell_invoice_analyser.py'),
+                                       '--serve', str(port), self.data_base], stdout=null, stderr=null)
+        deadline = time.time() + SERVER_START_TIMEOUT
+        while time.time() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', port), 1).close()
+                return server, port
+            except socket.error:
+                time.sleep(0.05)
+        server.kill()
+        self.fail('The server did not start within {0}s'.format(SERVER_START_TIMEOUT))
+
+    def request(self, port, path, start, results):
+        connection = httplib.HTTPConnection('127.0.0.1', port, timeout=SERVER_START_TIMEOUT)
+        try:
+            start.wait()
+            connection.request('GET', path)
+            response = connection.getresponse()
+            results.append((path, response.status, json.loads(response.read())))
+        except (httplib.HTTPException, socket.error) as error:
+            results.append((path, repr(error), None))
+        finally:
+            connection.close()
+
+    def test_concurrent_first_requests(self):
+        paths = ['/month/2012-{0:02d}'.format(index % NUM_MONTHS + 1) for index in xrange(NUM_CLIENTS)]
+
+        for index in xrange(NUM_STARTS):
+            server, port = self.start_server()
+            try:
+                start = threading.Event()
+                results = []
+                clients = [threading.Thread(target=self.request, args=(port, path, start, results))
+                           for path in paths]
+                for client in clients:
+                    client.start()
+                start.set()
+                for client in clients:
+                    client.join()
+            finally:
+                server.terminate()
+                server.wait()
+
+            self.assertEqual(sorted((path, status) for path, status, body in results),
+                             sorted((path, 200) for path in paths))
+            for path, status, body in results:
+                self.assertEqual(body['billing_date'][:7], path[-7:])
+
+    def test_invalid_month(self):
+        server, port = self.start_server()
+        try:
+            start = threading.Event()
+            start.set()
+            results = []
+            self.request(port, '/month/2012-13', start, results)
+        finally:
+            server.terminate()
+            server.wait()
+        self.assertEqual(results[0][1], 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+'''
+Every line of an account is costed as a contract of its own, charged the base
+fee and granted the allowances once per month.
+'''
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from helpers import create_data_base
+
+from evn_generator import generate_subscribers
+from invoice_constants import SUBSCRIBER_SEPARATORS
+from invoice_queries import open_data_base
+
+try:
+    import numpy as np
+    import tariff_simulator
+except ImportError:
+    np = None
+
+
+NUM_MONTHS = 4
+PLANS = [{'name': 'flat', 'base_fee': 10.0, 'included': {'calls': None, 'SMS': None, 'GPRS': None}},
+         {'name': 'allowance', 'base_fee': 5.0,
+          'rates': {'calls': 0.09, 'SMS': 0.09, 'GPRS': 0.0049},
+          'included': {'calls': 100, 'SMS': 10, 'GPRS': 1024}}]
+
+
+@unittest.skipIf(np is None, 'requires numpy')
+class TariffLinesTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.temp_dir = tempfile.mkdtemp()
+        cls.data_base = os.path.join(cls.temp_dir, 'tariffs.db')
+        cls.subscribers = [subscriber.translate(None, SUBSCRIBER_SEPARATORS)
+                           for subscriber in generate_subscribers(3)]
+        create_data_base(cls.data_base, NUM_MONTHS, num_lines=100,
+                         subscribers=generate_subscribers(3))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.temp_dir)
+
+    def simulate(self, subscriber=None):
+        connection = open_data_base(self.data_base)
+        try:
+            usage = tariff_simulator.load_usage(connection, subscriber)
+        finally:
+            connection.close()
+        return usage, tariff_simulator.simulate(usage, tariff_simulator.Plans(PLANS))
+
+    def test_base_fee_per_line(self):
+        usage, costs = self.simulate()
+        self.assertEqual(usage.lines, self.subscribers)
+        np.testing.assert_allclose(costs[0], [3 * 10.0] * NUM_MONTHS)
+
+        usage, costs = self.simulate(self.subscribers[0])
+        self.assertEqual(usage.lines, self.subscribers[:1])
+        np.testing.assert_allclose(costs[0], [10.0] * NUM_MONTHS)
+
+    def test_account_sums_lines(self):
+        usage, account_costs = self.simulate()
+        line_costs = sum(self.simulate(subscriber)[1] for subscriber in self.subscribers)
+        np.testing.assert_allclose(account_costs, line_costs)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+'''
+Statistics of the monthly usage of each connection type along with its
+percentiles, over a range of billing dates or over a window rolling over them.
+
+The usage of each connection type per line and billing date is fetched in a
+single statement, the range of billing dates being selected by the data base,
+into one array per type. The rows of all windows are gathered from it into a
+matrix with one row per window, which is sorted once, so the statistics and
+percentiles of all windows are computed without looping over them.
+'''
+
+from itertools import groupby
+
+import numpy as np
+
+from invoice_queries import get_month_conditions
+
+
+PERCENTILES = (50, 90, 99)
+
+
+def load_usage(connection, subscriber=None, first_month=None, last_month=None, by_line=False):
+    '''
+    load the amount, net and gross amount of each connection type per line and
+    billing date from the given first through the given last month, of all
+    lines, of the given line only or by line, in a single statement
+
+    return the billing dates and, by line (None unless by line), by type an
+    array of the month indices, amounts, net and gross amounts ordered by
+    billing date
+    '''
+    conditions = []
+    params = []
+    rows = None
+    lines = {}
+
+    conditions, params = get_month_conditions('date_date', first_month, last_month)
+    if subscriber is not None:
+        conditions.append('subscriber = ?')
+        params.append(subscriber)
+
+    rows = connection.execute('SELECT {0}, type_, date_date, amount, net, gross '\
+                              'FROM connection_type {1} '\
+                              'ORDER BY 1, type_, date_date'.format('subscriber' if by_line else 'NULL',
+                                                                    'WHERE ' + ' AND '.join(conditions)
+                                                                    if conditions else ''),
+                              params).fetchall()
+
+    months = sorted(set(row[2] for row in rows))
+    month_indices = dict((billing_date, index) for index, billing_date in enumerate(months))
+    for (line, type_), type_rows in groupby(rows, lambda row: row[:2]):
+        lines.setdefault(line, {})[type_] = np.array([(month_indices[row[2]],) + row[3:]
+                                                      for row in type_rows], dtype=np.float64)
+
+    return months, lines
+
+
+def compute_windows(usage, num_months, window):
+    '''
+    compute the statistics and percentiles of the amounts in each window of
+    the given number of consecutive billing dates out of all, from an array
+    of month indices, amounts, net and gross amounts as by `load_usage`
+
+    return the indices of the windows holding any amounts along with the
+    count, mean, M2, min, max, mean net and gross amount and the percentiles
+    of each of them
+    '''
+    month_indices = usage[:, 0]
+    # the rows of a window are contiguous as they are ordered by billing date
+    starts = np.searchsorted(month_indices, np.arange(num_months - window + 1))
+    ends = np.searchsorted(month_indices, np.arange(window - 1, num_months), side='right')
+    filled = np.flatnonzero(ends > starts)
+    starts, counts = starts[filled], (ends - starts)[filled]
+
+    # gather the rows of each window into a matrix, padding the shorter ones
+    offsets = np.arange(counts.max())
+    present = offsets < counts[:, np.newaxis]
+    rows = np.where(present, starts[:, np.newaxis] + offsets, 0)
+    amounts = np.where(present, usage[rows, 1], np.inf)
+    # sort the padding to the end of each window
+    amounts.sort(axis=1)
+    amounts[~present] = 0.0
+
+    windows = np.arange(len(counts))[:, np.newaxis]
+    means = amounts.sum(axis=1) / counts
+    m2s = (np.where(present, amounts - means[:, np.newaxis], 0.0) ** 2).sum(axis=1)
+    nets = np.where(present, usage[rows, 2], 0.0).sum(axis=1) / counts
+    grosses = np.where(present, usage[rows, 3], 0.0).sum(axis=1) / counts
+
+    # interpolate linearly between the closest ranks
+    ranks = (counts[:, np.newaxis] - 1) * (np.array(PERCENTILES) / 100.0)
+    lower = np.floor(ranks).astype(np.int64)
+    upper = np.minimum(lower + 1, counts[:, np.newaxis] - 1)
+    fractions = ranks - lower
+    percentiles = amounts[windows, lower] * (1 - fractions) + amounts[windows, upper] * fractions
+
+    stats = zip(counts.tolist(), means.tolist(), m2s.tolist(),
+                amounts[:, 0].astype(np.int64).tolist(),
+                amounts[windows[:, 0], counts - 1].astype(np.int64).tolist(),
+                nets.tolist(), grosses.tolist())
+    return filled.tolist(), stats, [tuple(row) for row in percentiles.tolist()]
+
+
+def compute_stats(connection, window=None, subscriber=None, first_month=None, last_month=None,
+                  by_line=False):
+    '''
+    compute the statistics and percentiles of each connection type over each
+    window of the given number of consecutive billing dates, or over all
+    billing dates, from the given first through the given last month, of all
+    lines, of the given line only or by line
+
+    return by line (None unless by line) a list of the first and last billing
+    date of each window along with the statistics and percentiles by type,
+    statistics being count, mean, M2, min, max and the mean net and gross
+    amount as by `invoice_queries.fetch_connection_stats`, the list is
+    empty if there are fewer billing dates than the window
+    '''
+    lines = {}
+
+    months, usage = load_usage(connection, subscriber, first_month, last_month, by_line)
+    window = window or len(months)
+    for line, types in usage.items():
+        lines[line] = [(months[end - window + 1], months[end], {}, {})
+                       for end in xrange(window - 1, len(months))]
+        if not lines[line]:
+            continue
+        for type_, type_usage in types.items():
+            for index, stats, percentiles in zip(*compute_windows(type_usage, len(months), window)):
+                lines[line][index][2][type_] = stats
+                lines[line][index][3][type_] = percentiles
+
+    return lines